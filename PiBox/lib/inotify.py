@@ -0,0 +1,184 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT = struct.Struct("iIII")
+
+# changes on network filesystems are not reported by inotify
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs")
+
+
+class Watcher(threading.Thread):
+    """ watch a directory tree recursively with linux inotify and call the
+        callback with the set of changed directories, after no further
+        events arrived for the given delay.
+    """
+    daemon = True
+
+    def __init__(self, root, callback, delay=.5):
+        threading.Thread.__init__(self)
+        self.root = root.rstrip("/")
+        self.callback = callback
+        self.delay = delay
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.paths = {}
+        self.network_mounts = self._network_mounts()
+        self.keep_running = True
+        self.add_tree(self.root)
+
+    def _network_mounts(self):
+        """ return: the mount points of network filesystems
+        """
+        mounts = []
+        try:
+            with open("/proc/mounts", "r") as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) > 2 and fields[2] in NETWORK_FILESYSTEMS:
+                        mounts.append(fields[1].replace("\\040", " "))
+        except OSError:
+            pass
+        return mounts
+
+    def _on_network(self, path):
+        real = os.path.realpath(path)
+        return any(real == mount or real.startswith(mount.rstrip("/") + "/")
+                   for mount in self.network_mounts)
+
+    def add_watch(self, path):
+        """ add a single directory to the watches.
+            return: False if the directory can not be watched.
+        """
+        if self._on_network(path):
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                print("| inotify watch limit reached: %s" % path, flush=True)
+            return False
+        with self.lock:
+            old = self.watches.get(wd)
+            if old is not None and old != path:
+                self.paths.pop(old, None)
+            self.watches[wd] = path
+            self.paths[path] = wd
+        return True
+
+    def add_tree(self, path):
+        """ add a directory and all subdirectories to the watches
+        """
+        seen = set()
+        for root, directories, files in os.walk(path, followlinks=True):
+            real = os.path.realpath(root)
+            if real in seen or not self.add_watch(root):
+                directories[:] = []
+                continue
+            seen.add(real)
+
+    def remove_tree(self, path):
+        """ remove a directory and all subdirectories from the watches
+        """
+        with self.lock:
+            for watched in [p for p in self.paths
+                            if p == path or p.startswith(path + "/")]:
+                wd = self.paths.pop(watched)
+                self.watches.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def is_watched(self, path):
+        """ return: True if changes in the directory are reported
+        """
+        return path.rstrip("/") in self.paths
+
+    def run(self):
+        changed = set()
+        while self.keep_running:
+            try:
+                readable, _, _ = select.select([self.fd], [], [], self.delay)
+            except (OSError, ValueError):
+                break
+            if readable:
+                try:
+                    buffer = os.read(self.fd, 65536)
+                except OSError:
+                    break
+                changed.update(self._read_events(buffer))
+            elif changed:
+                try:
+                    self.callback(changed)
+                except Exception as e:
+                    print("| inotify callback error: %s" % e, flush=True)
+                changed = set()
+
+    def _read_events(self, buffer):
+        """ handle the events in buffer.
+            return: the set of changed directories.
+        """
+        changed = set()
+        offset = 0
+        while offset + EVENT.size <= len(buffer):
+            wd, mask, cookie, length = EVENT.unpack_from(buffer, offset)
+            name = os.fsdecode(buffer[offset + EVENT.size:
+                                      offset + EVENT.size + length].rstrip(b"\0"))
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events are lost, so everything has to be checked again
+                with self.lock:
+                    changed.update(self.paths)
+                continue
+            with self.lock:
+                directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                with self.lock:
+                    self.watches.pop(wd, None)
+                    if self.paths.get(directory) == wd:
+                        del self.paths[directory]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+            changed.add(directory)
+            if mask & IN_ISDIR:
+                path = os.path.join(directory, name)
+                changed.add(path)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.remove_tree(path)
+        return changed
+
+    def close(self):
+        """ stop watching and close the inotify instance
+        """
+        self.keep_running = False
+        os.close(self.fd)
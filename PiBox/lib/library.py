@@ -0,0 +1,477 @@
+import os
+import json
+import math
+import heapq
+import random
+import sqlite3
+import threading
+
+from . import tagreader
+
+
+class MediaLibrary:
+    """ persistent index of the directories and playable files below the
+        root directory, stored in a sqlite database. a directory is only
+        listed again if its mtime has changed since the last scan, so
+        browsing and queueing is answered from the index.
+    """
+    max_results = 1000  # results of a search, that are counted and paged
+    short_query = 3     # queries with shorter words are not ranked as a whole
+
+    def __init__(self, db_path, root, extensions):
+        self.root = root.rstrip("/")
+        self.extensions = tuple(extensions) + (".m3u",)
+        self.lock = threading.RLock()
+        self.reading = threading.Event()
+        self.reading.set()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # replaced rows have to fire the delete triggers of the search index
+        self.db.execute("PRAGMA recursive_triggers=ON")
+        self._create_tables()
+        self.fts = self._create_search_index()
+
+    def is_watched(self, path):
+        return False
+
+    def set_fn_is_watched(self, fn):
+        """ set a function, that return True if changes of a directory are
+            reported with rescan(), so the directory is not checked on access.
+        """
+        self.is_watched = fn
+
+    def _create_tables(self):
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta ("
+                            "key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS directories ("
+                            "path TEXT PRIMARY KEY, parent TEXT, name TEXT, "
+                            "mtime_ns INTEGER, entries INTEGER)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                            "path TEXT PRIMARY KEY, directory TEXT, name TEXT, "
+                            "size INTEGER, mtime_ns INTEGER, artist TEXT, "
+                            "title TEXT, album TEXT, duration INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS directories_parent "
+                            "ON directories(parent)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_directory "
+                            "ON files(directory)")
+            # a changed root or extension list invalidates the whole index
+            settings = json.dumps([self.root, sorted(self.extensions)])
+            row = self.db.execute("SELECT value FROM meta WHERE key='settings'").fetchone()
+            self.settings_changed = row is None or row["value"] != settings
+            if self.settings_changed:
+                self.db.execute("DELETE FROM directories")
+                self.db.execute("DELETE FROM files")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('settings', ?)",
+                                (settings,))
+
+    def _create_search_index(self):
+        """ create the full text index over path, title, artist and album of
+            the files, kept up to date by triggers on the files table.
+            return: False if sqlite is compiled without FTS5.
+        """
+        start = len(self.root) + 2 # index the path relative to the root
+        with self.lock, self.db:
+            self.db.execute("DROP VIEW IF EXISTS search_content")
+            self.db.execute("CREATE VIEW search_content AS SELECT rowid, "
+                            "substr(path, %d) AS path, title, artist, album FROM files" % start)
+            for trigger in ("files_insert", "files_delete", "files_update"):
+                self.db.execute("DROP TRIGGER IF EXISTS %s" % trigger)
+            exists = self.db.execute("SELECT sql FROM sqlite_master "
+                                     "WHERE name='search'").fetchone()
+            # an index without the prefix indexes of older versions is rebuilt
+            if exists and "prefix" not in exists["sql"]:
+                self.db.execute("DROP TABLE search")
+                exists = None
+            try:
+                # short prefixes are looked up in their own indexes, instead
+                # of merging the entries of every word they start
+                self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5("
+                                "path, title, artist, album, content='search_content', "
+                                "content_rowid='rowid', prefix='1 2', "
+                                "tokenize='unicode61 remove_diacritics 2')")
+            except sqlite3.OperationalError:
+                return False
+            insert = ("INSERT INTO search(rowid, path, title, artist, album) VALUES "
+                      "(new.rowid, substr(new.path, %d), new.title, new.artist, new.album);"
+                      % start)
+            delete = ("INSERT INTO search(search, rowid, path, title, artist, album) VALUES "
+                      "('delete', old.rowid, substr(old.path, %d), old.title, old.artist, "
+                      "old.album);" % start)
+            self.db.execute("CREATE TRIGGER files_insert AFTER INSERT ON files "
+                            "BEGIN %s END" % insert)
+            self.db.execute("CREATE TRIGGER files_delete AFTER DELETE ON files "
+                            "BEGIN %s END" % delete)
+            self.db.execute("CREATE TRIGGER files_update AFTER UPDATE ON files "
+                            "BEGIN %s %s END" % (delete, insert))
+            if not exists or self.settings_changed:
+                self.db.execute("INSERT INTO search(search) VALUES ('rebuild')")
+        return True
+
+    def contains(self, path):
+        """ return: True if the path is inside the indexed root directory
+        """
+        return path == self.root or path.startswith(self.root + "/")
+
+    def refresh(self, path=None, depth=None):
+        """ rescan the directories below path, whose mtime has changed.
+            args:
+                path(str): the directory to start, default is the root.
+                depth(int): how many levels to descend, None for all.
+        """
+        path = (path or self.root).rstrip("/")
+        stack = [(path, 0)]
+        seen = set()
+        while stack:
+            directory, level = stack.pop()
+            real = os.path.realpath(directory)
+            if real in seen:
+                continue
+            seen.add(real)
+            with self.lock, self.db:
+                subdirs = self._refresh_directory(directory)
+            if depth is None or level < depth:
+                stack.extend((subdir, level + 1) for subdir in subdirs)
+
+    def _refresh_directory(self, directory):
+        """ rescan a single directory, if its mtime has changed.
+            return: the paths of its subdirectories.
+        """
+        row = self.db.execute("SELECT mtime_ns FROM directories WHERE path=?",
+                              (directory,)).fetchone()
+        if row is not None and row["mtime_ns"] is not None and self.is_watched(directory):
+            return self._get_subdirs(directory)
+        try:
+            stat = os.stat(directory)
+        except OSError:
+            self._remove_directory(directory)
+            return []
+        if row is not None and row["mtime_ns"] == stat.st_mtime_ns:
+            return self._get_subdirs(directory)
+        return self._scan_directory(directory, stat)
+
+    def _get_subdirs(self, directory):
+        return [row["path"] for row in self.db.execute(
+            "SELECT path FROM directories WHERE parent=?", (directory,))]
+
+    def rescan(self, path):
+        """ list a directory again, regardless of its mtime. used for changes
+            that do not touch the mtime, like modified files. new
+            subdirectories, e.g. of a moved in tree, are scanned recursively.
+        """
+        path = path.rstrip("/")
+        with self.lock, self.db:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._remove_directory(path)
+                return
+            self._scan_directory(path, stat)
+            new = [row["path"] for row in self.db.execute(
+                "SELECT path FROM directories WHERE parent=? AND mtime_ns IS NULL", (path,))]
+        for subdir in new:
+            self.refresh(subdir)
+
+    def _scan_directory(self, directory, stat):
+        """ list a directory and write the changes to the index.
+            return: the paths of its subdirectories.
+        """
+        subdirs = {}
+        files = {}
+        entries = 0
+        try:
+            with os.scandir(directory) as scan:
+                for entry in scan:
+                    entries += 1
+                    try:
+                        if entry.is_dir():
+                            subdirs[entry.path] = entry.name
+                        elif entry.name.endswith(self.extensions) and entry.is_file():
+                            files[entry.path] = (entry.name, entry.stat())
+                    except OSError:
+                        continue
+        except OSError:
+            self._remove_directory(directory)
+            return []
+        parent, name = directory.rsplit("/", 1)
+        self.db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)",
+                        (directory, parent, name, stat.st_mtime_ns, entries))
+        # update the files of this directory
+        known = {row["path"]: (row["mtime_ns"], row["size"]) for row in self.db.execute(
+            "SELECT path, mtime_ns, size FROM files WHERE directory=?", (directory,))}
+        for path in known.keys() - files.keys():
+            self.db.execute("DELETE FROM files WHERE path=?", (path,))
+        for path, (name, file_stat) in files.items():
+            if known.get(path) != (file_stat.st_mtime_ns, file_stat.st_size):
+                self.db.execute("INSERT OR REPLACE INTO files (path, directory, name, "
+                                "size, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                                (path, directory, name, file_stat.st_size,
+                                 file_stat.st_mtime_ns))
+        # update the subdirectories of this directory
+        known = {row["path"] for row in self.db.execute(
+            "SELECT path FROM directories WHERE parent=?", (directory,))}
+        for path in known - subdirs.keys():
+            self._remove_directory(path)
+        for path in subdirs.keys() - known:
+            self.db.execute("INSERT INTO directories VALUES (?, ?, ?, NULL, NULL)",
+                            (path, directory, subdirs[path]))
+        return list(subdirs)
+
+    def _remove_directory(self, directory):
+        """ remove a directory and everything below from the index
+        """
+        # all paths below "dir/" sort between "dir/" and "dir0"
+        lower, upper = directory + "/", directory + "0"
+        self.db.execute("DELETE FROM directories WHERE path=? OR (path>=? AND path<?)",
+                        (directory, lower, upper))
+        self.db.execute("DELETE FROM files WHERE directory=? OR (directory>=? AND directory<?)",
+                        (directory, lower, upper))
+
+    def _files_below(self, path, extensions):
+        """ return: a sql condition and its arguments, that matches all files
+                    below path with one of the extensions.
+        """
+        where = "(directory=? OR (directory>=? AND directory<?)) AND (%s)" % (
+            " OR ".join(["substr(name, ?)=?"] * len(extensions)))
+        args = [path, path + "/", path + "0"]
+        for extension in extensions:
+            args.extend((-len(extension), extension))
+        return where, args
+
+    def get_directory(self, path):
+        """ return the content of a single directory, sorted by name.
+            return: a tuple (directories, files) of lists of dicts.
+        """
+        path = path.rstrip("/")
+        self.refresh(path, depth=1)
+        with self.lock:
+            directories = [dict(row) for row in self.db.execute(
+                "SELECT path, name, entries FROM directories WHERE parent=? "
+                "ORDER BY name", (path,))]
+            files = [dict(row) for row in self.db.execute(
+                "SELECT * FROM files WHERE directory=? ORDER BY name", (path,))]
+        return directories, files
+
+    def get_files(self, path, extensions=None):
+        """ return the paths of all files below path, each directory sorted
+            by name and followed by its subdirectories.
+            args:
+                path(str): the directory to start.
+                extensions(list): only return files with these extensions.
+        """
+        path = path.rstrip("/")
+        extensions = tuple(extensions or self.extensions)
+        self.refresh(path)
+        filelist = []
+        stack = [path]
+        with self.lock:
+            while stack:
+                directory = stack.pop()
+                for row in self.db.execute("SELECT path, name FROM files "
+                                           "WHERE directory=? ORDER BY name",
+                                           (directory,)):
+                    if row["name"].endswith(extensions):
+                        filelist.append(row["path"])
+                stack.extend(reversed([row["path"] for row in self.db.execute(
+                    "SELECT path FROM directories WHERE parent=? ORDER BY name",
+                    (directory,))]))
+        return filelist
+
+    def sample_files(self, path, count, extensions=None, per_directory=False):
+        """ return count random files below path, picked by the database.
+            args:
+                path(str): the directory to pick from.
+                count(int): the number of files.
+                extensions(list): only pick files with these extensions.
+                per_directory(bool): give every directory the same chance,
+                                     instead of every file.
+        """
+        path = path.rstrip("/")
+        extensions = tuple(extensions or self.extensions)
+        self.refresh(path)
+        where, args = self._files_below(path, extensions)
+        with self.lock:
+            if not per_directory:
+                return [row["path"] for row in self.db.execute(
+                    "SELECT path FROM files WHERE %s ORDER BY random() LIMIT ?" % where,
+                    args + [count])]
+            rows = self.db.execute(
+                "SELECT files.path, amounts.amount FROM files JOIN ("
+                "SELECT directory, COUNT(*) AS amount FROM files WHERE %s "
+                "GROUP BY directory) AS amounts USING (directory) WHERE %s" % (where, where),
+                args + args)
+            return reservoir_sample(((row["path"], row["amount"]) for row in rows),
+                                    count, per_directory)
+
+    def get_tags(self, paths):
+        """ return the tags of the files, read with the tagreader. the tags
+            of indexed files are cached as long as mtime and size are unchanged.
+            return: a dict {path: {"artist", "title", "album", "duration"}},
+                    the duration is 0 if it is unknown.
+        """
+        result = {}
+        for chunk in range(0, len(paths), 500):
+            part = paths[chunk:chunk + 500]
+            with self.lock:
+                cached = {row["path"]: row for row in self.db.execute(
+                    "SELECT * FROM files WHERE path IN (%s)" % ",".join("?" * len(part)),
+                    part)}
+            # the files are read without holding the lock
+            read = []
+            for path in part:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                row = cached.get(path)
+                if (row is not None and row["duration"] is not None and
+                        row["mtime_ns"] == stat.st_mtime_ns and row["size"] == stat.st_size):
+                    result[path] = {"artist": row["artist"],
+                                    "title": row["title"],
+                                    "album": row["album"],
+                                    "duration": row["duration"]}
+                    continue
+                tags = tagreader.read_tags(path) or {"artist": None, "title": None,
+                                                     "album": None, "duration": 0}
+                result[path] = tags
+                if self.contains(path):
+                    read.append((path, stat, tags))
+            if read:
+                with self.lock, self.db:
+                    for path, stat, tags in read:
+                        directory, name = path.rsplit("/", 1)
+                        self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                                        "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (path, directory, name, stat.st_size, stat.st_mtime_ns,
+                                         tags["artist"], tags["title"], tags["album"],
+                                         tags["duration"]))
+        return result
+
+    def read_missing_tags(self, batch=50):
+        """ read the tags of all indexed files, that were not read yet, so
+            they can be searched. meant to run in the background, it returns
+            after the current batch once stop_reading() is called.
+            return: the number of read files.
+        """
+        amount = 0
+        while self.reading.is_set():
+            with self.lock:
+                paths = [row["path"] for row in self.db.execute(
+                    "SELECT path FROM files WHERE duration IS NULL LIMIT ?", (batch,))]
+            if not paths:
+                return amount
+            tags = self.get_tags(paths)
+            # vanished files are marked as read, until the next rescan
+            with self.lock, self.db:
+                for path in paths:
+                    if path not in tags:
+                        self.db.execute("UPDATE files SET duration=0 WHERE path=? "
+                                        "AND duration IS NULL", (path,))
+            amount += len(paths)
+        return amount
+
+    def stop_reading(self):
+        """ stop read_missing_tags() after its current batch
+        """
+        self.reading.clear()
+
+    def search(self, query, offset=0, limit=50, extensions=None):
+        """ search the files by path, title, artist and album. every word of
+            the query has to match the beginning of a word.
+            args:
+                query(str): the words to search for.
+                offset(int): the number of results to skip.
+                limit(int): the maximum number of results.
+                extensions(list): only find files with these extensions.
+            return: a tuple (total, results), results are dicts of the file
+                    rows, the best match first. at most max_results are
+                    counted and paged.
+        """
+        words = [word for word in query.split() if word]
+        if not words or offset >= self.max_results:
+            return 0, []
+        limit = min(limit, self.max_results - offset)
+        # a short query matches a large part of the library, so only the
+        # first matches are sorted
+        short = max(len(word) for word in words) < self.short_query
+        extensions = tuple(extensions or self.extensions)
+        ext_where = " OR ".join(["substr(files.name, ?)=?"] * len(extensions))
+        ext_args = []
+        for extension in extensions:
+            ext_args.extend((-len(extension), extension))
+        with self.lock:
+            if self.fts:
+                match = " ".join('"%s"*' % word.replace('"', '""') for word in words)
+                sql = ("FROM search JOIN files ON files.rowid=search.rowid "
+                       "WHERE search MATCH ? AND (%s)" % ext_where)
+                args = [match] + ext_args
+                # a match in the title weighs more than in the path
+                columns = "files.*, bm25(search, 1.0, 10.0, 5.0, 3.0) AS score"
+                order = "ORDER BY score"
+            else:
+                where = []
+                args = []
+                for word in words:
+                    where.append("(%s)" % " OR ".join(
+                        ["instr(lower(%s), ?)" % column for column in (
+                            "substr(files.path, %d)" % (len(self.root) + 2),
+                            "files.title", "files.artist", "files.album")]))
+                    args.extend([word.lower()] * 4)
+                sql = "FROM files WHERE %s AND (%s)" % (" AND ".join(where), ext_where)
+                args += ext_args
+                columns = "files.*"
+                order = "ORDER BY title IS NULL, title, name"
+            matches = "SELECT %s %s" % (columns, sql)
+            if short:
+                matches += " LIMIT %d" % self.max_results
+            try:
+                total = self.db.execute("SELECT COUNT(*) FROM (SELECT 1 %s LIMIT %d)"
+                                        % (sql, self.max_results), args).fetchone()[0]
+                rows = self.db.execute("SELECT * FROM (%s) %s LIMIT ? OFFSET ?"
+                                       % (matches, order), args + [limit, offset])
+                results = [dict(row) for row in rows]
+            except sqlite3.OperationalError:
+                return 0, []
+            for result in results:
+                result.pop("score", None)
+            return total, results
+
+    def close(self):
+        """ close the database connection
+        """
+        with self.lock:
+            self.db.close()
+
+
+def iter_files(path, extensions):
+    """ yield a tuple (file, amount) for every file below path with one of
+        the extensions, where amount is the number of matching files in the
+        same directory. only one directory is held in memory.
+    """
+    extensions = tuple(extensions)
+    for root, directories, files in os.walk(path):
+        files = [filename for filename in files if filename.endswith(extensions)]
+        for filename in files:
+            yield os.path.join(root, filename), len(files)
+
+
+def reservoir_sample(items, count, per_directory=False):
+    """ pick count random items in a single pass with O(count) memory,
+        using weighted reservoir sampling (algorithm A-Res).
+        args:
+            items(iterable): tuples (item, amount), see iter_files().
+            count(int): the number of items to pick.
+            per_directory(bool): weight every item with 1/amount, so every
+                                 directory has the same chance.
+    """
+    reservoir = []
+    for item, amount in items:
+        # the key u^(1/weight) compared as logarithm, to prevent an underflow
+        key = math.log(1.0 - random.random()) * (amount if per_directory else 1)
+        if len(reservoir) < count:
+            heapq.heappush(reservoir, (key, item))
+        elif key > reservoir[0][0]:
+            heapq.heapreplace(reservoir, (key, item))
+    return [item for key, item in reservoir]
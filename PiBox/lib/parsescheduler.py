@@ -0,0 +1,113 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class ParseScheduler(threading.Thread):
+    """ start the metadata parsing of queued items with a fixed number of
+        parses in flight, always the item with the lowest priority first.
+        the parse itself runs asynchronous, done() has to be called when it
+        is finished. parses without done() are released after the timeout.
+    """
+    daemon = True
+
+    def __init__(self, start, stop, workers=2, timeout=10):
+        """ args:
+                start(function): start the parsing of an item.
+                stop(function): stop the parsing of an item.
+                workers(int): the maximum number of parses in flight.
+                timeout(int): seconds until a parse is given up.
+        """
+        threading.Thread.__init__(self)
+        self.start_parse = start
+        self.stop_parse = stop
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.queue = []    # heap of (priority, counter, key)
+        self.pending = {}  # key: item
+        self.running = {}  # key: (item, started)
+        self.stopping = []
+
+    def submit(self, key, item, priority):
+        """ queue an item for parsing
+        """
+        with self.condition:
+            self.pending[key] = item
+            heapq.heappush(self.queue, (priority, next(self.counter), key))
+            self.condition.notify()
+
+    def done(self, key):
+        """ release the slot of a finished parse
+        """
+        with self.condition:
+            if self.running.pop(key, None) is not None:
+                self.condition.notify()
+
+    def discard(self, keys):
+        """ drop pending items, that are not needed anymore
+        """
+        with self.condition:
+            for key in keys:
+                self.pending.pop(key, None)
+
+    def pending_keys(self):
+        with self.condition:
+            return list(self.pending)
+
+    def set_priorities(self, priorities):
+        """ change the priorities of pending items.
+            args:
+                priorities(dict): {key: priority}, other items keep theirs.
+        """
+        with self.condition:
+            queue = {}
+            for priority, count, key in self.queue:
+                if key in self.pending:
+                    queue[key] = (priorities.get(key, priority), count, key)
+            self.queue = list(queue.values())
+            heapq.heapify(self.queue)
+
+    def cancel(self):
+        """ drop all pending items and stop the running parses. returns
+            without waiting, the parses are stopped by the scheduler thread.
+        """
+        with self.condition:
+            self.queue = []
+            self.pending = {}
+            self.stopping.extend(item for item, started in self.running.values())
+            self.running = {}
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # give up parses, that never reported back
+                now = time.monotonic()
+                for key, (item, started) in list(self.running.items()):
+                    if now - started > self.timeout:
+                        del self.running[key]
+                stopping, self.stopping = self.stopping, []
+                starting = []
+                while self.queue and len(self.running) < self.workers:
+                    priority, count, key = heapq.heappop(self.queue)
+                    item = self.pending.pop(key, None)
+                    if item is not None and key not in self.running:
+                        self.running[key] = (item, now)
+                        starting.append((key, item))
+                if not stopping and not starting:
+                    self.condition.wait(self.timeout if self.running else None)
+                    continue
+            for item in stopping:
+                try:
+                    self.stop_parse(item)
+                except Exception as e:
+                    print("| parse stop error: %s" % e, flush=True)
+            for key, item in starting:
+                try:
+                    self.start_parse(item)
+                except Exception as e:
+                    print("| parse start error: %s" % e, flush=True)
+                    self.done(key)
@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+import time
+
+# the session is stored in two files, so the often changing playback state
+# can be written without the whole tracklist:
+#   tracklist: {"version": int, "tracks": [[mrl, artist, title, duration], ...]}
+#   state:     {"version": int, "index": int, "position": int, "state": str,
+#               "mode": str, "volume": int}
+# the version is the content version of the tracklist the state belongs to,
+# it does not change with the current track. the position changes all the
+# time while playing, a state where only the position changed is written
+# seldom, to spare the sd card.
+
+
+def write_atomic(path, data):
+    """ write the data as json to a temporary file and replace the file with
+        it, so a crash never leaves a half written file
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, separators=(',', ':'), ensure_ascii=False)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def read(path):
+    """ return: the json data of the file, or None if it is missing or broken
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+class Session:
+    """ save and load the tracklist and the playback state. only the changed
+        parts are written.
+    """
+    def __init__(self, directory, position_interval=300):
+        self.tracklist_path = os.path.join(directory, "session_tracklist.json")
+        self.state_path = os.path.join(directory, "session_state.json")
+        self.lock = threading.Lock()
+        self.tracklist_version = None
+        self.state = None
+        self.position_interval = position_interval  # seconds
+        self.state_written = 0
+
+    def save(self, version, tracks, state, position=False):
+        """ write the tracklist if its version changed and the state if it
+            changed. a change of only the position is written after the
+            position interval.
+            args:
+                version(int): the content version of the tracklist.
+                tracks(list): the records of the tracklist.
+                state(dict): the playback state.
+                position(bool): write a changed position at once.
+            return: True if something was written
+        """
+        with self.lock:
+            written = False
+            if version != self.tracklist_version:
+                write_atomic(self.tracklist_path, {
+                    "version": version,
+                    "tracks": [[track["mrl"], track["artist"], track["title"],
+                                track["duration"]] for track in tracks]})
+                self.tracklist_version = version
+                written = True
+            state = dict(state, version=version)
+            if state != self.state and (
+                    position or self.state is None or
+                    dict(state, position=0) != dict(self.state, position=0) or
+                    time.monotonic() - self.state_written >= self.position_interval):
+                write_atomic(self.state_path, state)
+                self.state = state
+                self.state_written = time.monotonic()
+                written = True
+            return written
+
+    def load(self):
+        """ return: a tuple (tracks, state) with the records of the tracks and
+                    the playback state, both None if there is no session.
+                    the state is None if it does not belong to the tracklist.
+        """
+        data = read(self.tracklist_path)
+        if not data:
+            return None, None
+        tracks = [{"mrl": mrl, "artist": artist, "title": title, "duration": duration}
+                  for mrl, artist, title, duration in data["tracks"]]
+        state = read(self.state_path)
+        if not state or state.get("version") != data["version"]:
+            state = None
+        return tracks, state
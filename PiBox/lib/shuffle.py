@@ -0,0 +1,199 @@
+import random
+import threading
+
+
+class ShuffleOrder:
+    """ the shuffled order of the tracks as lazy fisher-yates permutation.
+        the tracks are identified by a stable key (the media pointer), so the
+        order survives changes of the indices.
+
+        order[:decided] are the tracks already chosen in this round, the
+        cursor points to the current one. order[decided:] is the pool, the
+        next track is drawn from it on demand. so next, prev, add and remove
+        are O(1) and every track is played once before the next round starts.
+        removed tracks in the chosen part leave a hole (None), that is skipped
+        and compacted once there are too many of them.
+        peek draws a candidate without changing the order, it is chosen by the
+        next call of next, so a jump with set_current does not skip it.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.order = []
+        self.positions = {}  # key: position in order
+        self.decided = 0
+        self.cursor = -1
+        self.holes = 0
+        self.avoid_last = False
+        self.candidate = None  # the key peek drew from the pool
+
+    def __len__(self):
+        return len(self.positions)
+
+    def reset(self, keys, current=None):
+        """ start a new round with the keys.
+            args:
+                keys(list): the keys of all tracks.
+                current: the key of the current track, it starts the round.
+        """
+        with self.lock:
+            self.order = list(keys)
+            self.positions = {key: i for i, key in enumerate(self.order)}
+            self.decided = 0
+            self.cursor = -1
+            self.holes = 0
+            self.avoid_last = False
+            self.candidate = None
+            if current is not None:
+                self.set_current(current)
+
+    def clear(self):
+        self.reset([])
+
+    def add(self, key):
+        """ add a track to the pool of the running round
+        """
+        with self.lock:
+            if key in self.positions:
+                return
+            self.positions[key] = len(self.order)
+            self.order.append(key)
+            self.avoid_last = False
+
+    def remove(self, key):
+        """ remove a track from the order
+        """
+        with self.lock:
+            position = self.positions.pop(key, None)
+            if position is None:
+                return
+            if key == self.candidate:
+                self.candidate = None
+            if position >= self.decided:
+                # swap with the last one of the pool
+                last = self.order.pop()
+                if position < len(self.order):
+                    self.order[position] = last
+                    self.positions[last] = position
+                self.avoid_last = False
+            else:
+                self.order[position] = None
+                self.holes += 1
+                if self.holes > 16 and self.holes * 2 > len(self.order):
+                    self._compact()
+
+    def set_current(self, key):
+        """ make the track the current one, a track from the pool is chosen
+            after the already chosen ones
+        """
+        with self.lock:
+            position = self.positions.get(key)
+            if position is None:
+                return
+            if position >= self.decided:
+                self._swap(position, self.decided)
+                position = self.decided
+                self.decided += 1
+            self.cursor = position
+
+    def current(self):
+        """ return: the key of the current track, or None
+        """
+        with self.lock:
+            if 0 <= self.cursor < self.decided:
+                return self.order[self.cursor]
+            return None
+
+    def peek(self):
+        """ return: the key of the next track without moving to it, it stays
+                    the same until the order changes, or None if empty
+        """
+        with self.lock:
+            position = self._chosen_position()
+            if position is not None:
+                return self.order[position]
+            return self._draw()
+
+    def next(self):
+        """ move to the next track.
+            return: its key, or None if empty
+        """
+        with self.lock:
+            position = self._chosen_position()
+            if position is None:
+                key = self._draw()
+                if key is None:
+                    return None
+                if self.decided == len(self.order):
+                    self._new_round()
+                position = self.positions[key]
+                self._swap(position, self.decided)
+                self.decided += 1
+                self.candidate = None
+                position = self.decided - 1
+            self.cursor = position
+            return self.order[position]
+
+    def prev(self):
+        """ move back to the previous track of this round.
+            return: its key, or None at the beginning of the round
+        """
+        with self.lock:
+            position = self.cursor - 1
+            while position >= 0 and self.order[position] is None:
+                position -= 1
+            if position < 0:
+                return None
+            self.cursor = position
+            return self.order[position]
+
+    def _chosen_position(self):
+        # the position of the next already chosen track, or None
+        position = self.cursor + 1
+        while position < self.decided and self.order[position] is None:
+            position += 1
+        return position if position < self.decided else None
+
+    def _draw(self):
+        # the candidate from the pool, drawn once and kept until it is chosen
+        # or removed. the order is not changed here
+        if not self.positions:
+            return None
+        if self.decided == len(self.order):
+            # the next round starts with any track but the current one
+            current = self.current()
+            if self.candidate is None or self.candidate == current:
+                keys = [key for key in self.positions if key != current]
+                self.candidate = random.choice(keys or [current])
+            return self.candidate
+        # never the last track of the previous round first
+        end = len(self.order)
+        if self.avoid_last and self.decided == 0 and end > 1:
+            end -= 1
+        position = self.positions.get(self.candidate, -1)
+        if not self.decided <= position < end:
+            self.candidate = self.order[random.randrange(self.decided, end)]
+        return self.candidate
+
+    def _new_round(self):
+        last = self.current()
+        self._compact()
+        self.decided = 0
+        self.cursor = -1
+        if last is not None:
+            self._swap(self.positions[last], len(self.order) - 1)
+            self.avoid_last = True
+
+    def _compact(self):
+        chosen = [key for key in self.order[:self.decided] if key is not None]
+        current = self.current()
+        self.order = chosen + self.order[self.decided:]
+        self.positions = {key: i for i, key in enumerate(self.order)}
+        self.decided = len(chosen)
+        self.cursor = self.positions[current] if current is not None else -1
+        self.holes = 0
+
+    def _swap(self, a, b):
+        if a != b:
+            self.order[a], self.order[b] = self.order[b], self.order[a]
+            self.positions[self.order[a]] = a
+            self.positions[self.order[b]] = b
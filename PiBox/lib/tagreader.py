@@ -0,0 +1,309 @@
+import os
+import struct
+
+# read the artist, title, album and duration of audio files without libvlc.
+# supported are ID3v1, ID3v2.2-2.4 and the mpeg frame headers of mp3 files,
+# vorbis comments of flac, ogg vorbis and opus files and the ilst atoms of mp4.
+
+ID3V2_FRAMES = {
+    b"TIT2": "title", b"TPE1": "artist", b"TALB": "album", b"TLEN": "length",
+    b"TT2": "title", b"TP1": "artist", b"TAL": "album", b"TLE": "length"
+}
+VORBIS_FIELDS = {"TITLE": "title", "ARTIST": "artist", "ALBUM": "album"}
+MP4_ATOMS = {b"\xa9nam": "title", b"\xa9ART": "artist", b"\xa9alb": "album"}
+MP4_CONTAINERS = (b"moov", b"udta", b"meta", b"ilst", b"trak", b"mdia")
+
+MPEG_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+}
+MPEG_SAMPLERATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000),
+                    2.5: (11025, 12000, 8000)}
+
+
+def read_tags(path):
+    """ read the tags of an audio file.
+        return: a dict {"artist", "title", "album", "duration"} with the
+                duration in ms, or None if the format is not supported.
+    """
+    try:
+        with open(path, "rb") as file:
+            head = file.read(12)
+            file.seek(0)
+            if head.startswith(b"fLaC"):
+                tags = _read_flac(file)
+            elif head.startswith(b"OggS"):
+                tags = _read_ogg(file)
+            elif head[4:8] == b"ftyp":
+                tags = _read_mp4(file)
+            elif head.startswith(b"ID3") or _is_mpeg_header(head):
+                tags = _read_mp3(file)
+            else:
+                return None
+    except (OSError, ValueError, struct.error, IndexError, KeyError):
+        return None
+    result = {"artist": None, "title": None, "album": None, "duration": 0}
+    result.update({key: value for key, value in tags.items()
+                   if key in result and value})
+    return result
+
+
+def _decode_text(data):
+    """ decode an ID3v2 text frame
+    """
+    encoding, data = data[0], data[1:]
+    if encoding == 1:
+        text = data.decode("utf-16", "replace")
+    elif encoding == 2:
+        text = data.decode("utf-16-be", "replace")
+    elif encoding == 3:
+        text = data.decode("utf-8", "replace")
+    else:
+        text = data.decode("latin-1")
+    return text.split("\x00")[0].strip()
+
+
+def _synchsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _read_id3v2(file):
+    """ read the ID3v2 tag at the beginning of the file.
+        return: the tags and the offset of the audio data.
+    """
+    header = file.read(10)
+    if not header.startswith(b"ID3"):
+        return {}, 0
+    version, flags = header[3], header[5]
+    size = _synchsafe(header[6:10])
+    data = file.read(size)
+    if flags & 0x80 and version < 4:
+        data = data.replace(b"\xff\x00", b"\xff")
+    offset = 0
+    if flags & 0x40:
+        # skip the extended header
+        if version == 4:
+            offset = _synchsafe(data[0:4])
+        else:
+            offset = struct.unpack(">I", data[0:4])[0] + 4
+    tags = {}
+    id_size, header_size = (3, 6) if version == 2 else (4, 10)
+    while offset + header_size <= len(data):
+        frame_id = data[offset:offset + id_size]
+        if not frame_id.strip(b"\x00"):
+            break
+        if version == 2:
+            frame_size = int.from_bytes(data[offset + 3:offset + 6], "big")
+        elif version == 4:
+            frame_size = _synchsafe(data[offset + 4:offset + 8])
+        else:
+            frame_size = struct.unpack(">I", data[offset + 4:offset + 8])[0]
+        frame = data[offset + header_size:offset + header_size + frame_size]
+        offset += header_size + frame_size
+        if frame_id in ID3V2_FRAMES and frame:
+            tags[ID3V2_FRAMES[frame_id]] = _decode_text(frame)
+    return tags, 10 + size + (10 if flags & 0x10 else 0)
+
+
+def _read_id3v1(file):
+    """ read the ID3v1 tag at the end of the file
+    """
+    if os.fstat(file.fileno()).st_size < 128:
+        return {}
+    file.seek(-128, os.SEEK_END)
+    data = file.read(128)
+    if not data.startswith(b"TAG"):
+        return {}
+    fields = ("title", data[3:33]), ("artist", data[33:63]), ("album", data[63:93])
+    return {key: value.split(b"\x00")[0].decode("latin-1").strip()
+            for key, value in fields}
+
+
+def _is_mpeg_header(data):
+    return len(data) >= 4 and data[0] == 0xff and data[1] & 0xe0 == 0xe0
+
+
+def _read_mp3(file):
+    tags, audio_start = _read_id3v2(file)
+    file_size = os.fstat(file.fileno()).st_size
+    for key, value in _read_id3v1(file).items():
+        if not tags.get(key):
+            tags[key] = value
+    # search the first frame header, behind the ID3v2 tag
+    file.seek(audio_start)
+    data = file.read(8192)
+    for position in range(len(data) - 4):
+        if _is_mpeg_header(data[position:position + 4]):
+            duration = _mpeg_duration(data[position:], file_size - audio_start - position)
+            if duration:
+                tags["duration"] = duration
+                break
+    if not tags.get("duration") and tags.get("length", "").isdigit():
+        tags["duration"] = int(tags["length"])
+    return tags
+
+
+def _mpeg_duration(data, audio_size):
+    """ return: the duration in ms, based on the frame header at the
+                beginning of data and a Xing or VBRI header if present.
+    """
+    version_bits = (data[1] >> 3) & 0x03
+    layer_bits = (data[1] >> 1) & 0x03
+    bitrate_index = data[2] >> 4
+    samplerate_index = (data[2] >> 2) & 0x03
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or samplerate_index == 3:
+        return 0
+    version = {0: 2.5, 2: 2, 3: 1}[version_bits]
+    layer = 4 - layer_bits
+    samplerate = MPEG_SAMPLERATES[version][samplerate_index]
+    bitrate = MPEG_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    if layer == 1:
+        samples = 384
+    elif layer == 3 and version != 1:
+        samples = 576
+    else:
+        samples = 1152
+    mono = (data[3] >> 6) == 3
+    if version == 1:
+        xing = 21 if mono else 36
+    else:
+        xing = 13 if mono else 21
+    frames = None
+    if data[xing:xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+        if flags & 0x01:
+            frames = struct.unpack(">I", data[xing + 8:xing + 12])[0]
+    elif data[36:40] == b"VBRI":
+        frames = struct.unpack(">I", data[50:54])[0]
+    if frames:
+        return int(frames * samples * 1000 / samplerate)
+    return int(audio_size * 8 * 1000 / bitrate)
+
+
+def _parse_vorbis_comment(data):
+    vendor_length = struct.unpack("<I", data[0:4])[0]
+    offset = 4 + vendor_length
+    count = struct.unpack("<I", data[offset:offset + 4])[0]
+    offset += 4
+    tags = {}
+    for i in range(count):
+        length = struct.unpack("<I", data[offset:offset + 4])[0]
+        comment = data[offset + 4:offset + 4 + length].decode("utf-8", "replace")
+        offset += 4 + length
+        key, _, value = comment.partition("=")
+        key = VORBIS_FIELDS.get(key.upper())
+        if key and not tags.get(key):
+            tags[key] = value.strip()
+    return tags
+
+
+def _read_flac(file):
+    file.seek(4)
+    tags = {}
+    last = False
+    while not last:
+        header = file.read(4)
+        if len(header) < 4:
+            break
+        last = bool(header[0] & 0x80)
+        block_type = header[0] & 0x7f
+        size = int.from_bytes(header[1:4], "big")
+        if block_type == 0:
+            info = file.read(size)
+            samplerate = int.from_bytes(info[10:13], "big") >> 4
+            samples = int.from_bytes(info[13:18], "big") & 0xfffffffff
+            if samplerate:
+                tags["duration"] = int(samples * 1000 / samplerate)
+        elif block_type == 4:
+            tags.update(_parse_vorbis_comment(file.read(size)))
+        else:
+            file.seek(size, os.SEEK_CUR)
+    return tags
+
+
+def _ogg_packets(file):
+    """ yield the packets of the first logical stream of an ogg file
+    """
+    packet = b""
+    while True:
+        header = file.read(27)
+        if len(header) < 27 or not header.startswith(b"OggS"):
+            return
+        segments = file.read(header[26])
+        for length in segments:
+            packet += file.read(length)
+            if length < 255:
+                yield packet
+                packet = b""
+
+
+def _read_ogg(file):
+    tags = {}
+    samplerate, pre_skip = 0, 0
+    for number, packet in enumerate(_ogg_packets(file)):
+        if packet.startswith(b"\x01vorbis"):
+            samplerate = struct.unpack("<I", packet[12:16])[0]
+        elif packet.startswith(b"OpusHead"):
+            samplerate = 48000
+            pre_skip = struct.unpack("<H", packet[10:12])[0]
+        elif packet.startswith(b"\x03vorbis"):
+            tags.update(_parse_vorbis_comment(packet[7:]))
+        elif packet.startswith(b"OpusTags"):
+            tags.update(_parse_vorbis_comment(packet[8:]))
+        if tags or number > 2:
+            break
+    # the granule position of the last page is the number of samples
+    file_size = os.fstat(file.fileno()).st_size
+    file.seek(max(0, file_size - 65536))
+    data = file.read()
+    position = data.rfind(b"OggS")
+    if samplerate and position != -1 and len(data) >= position + 14:
+        granule = struct.unpack("<q", data[position + 6:position + 14])[0]
+        tags["duration"] = max(0, int((granule - pre_skip) * 1000 / samplerate))
+    return tags
+
+
+def _mp4_atoms(file, end):
+    """ yield the atoms (type, start of data, end) until end
+    """
+    while file.tell() + 8 <= end:
+        start = file.tell()
+        size, atom = struct.unpack(">I4s", file.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", file.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield atom, start + header, start + size
+        file.seek(start + size)
+
+
+def _read_mp4(file, end=None, tags=None):
+    if tags is None:
+        tags = {}
+        end = os.fstat(file.fileno()).st_size
+        file.seek(0)
+    for atom, start, atom_end in _mp4_atoms(file, end):
+        if atom in MP4_CONTAINERS:
+            file.seek(start + (4 if atom == b"meta" else 0))
+            _read_mp4(file, atom_end, tags)
+        elif atom == b"mvhd":
+            data = file.read(32)
+            if data[0] == 1:
+                timescale, duration = struct.unpack(">IQ", data[20:32])
+            else:
+                timescale, duration = struct.unpack(">II", data[12:20])
+            if timescale:
+                tags["duration"] = int(duration * 1000 / timescale)
+        elif atom in MP4_ATOMS:
+            data = file.read(atom_end - start)
+            if data[4:8] == b"data":
+                tags[MP4_ATOMS[atom]] = data[16:].decode("utf-8", "replace").strip()
+    return tags
@@ -0,0 +1,239 @@
+import threading
+
+
+def media_key(media):
+    """ return: the pointer of a libvlc media, it is the same for every
+                python object of the media
+    """
+    if media is None:
+        return None
+    return media._as_parameter_.value
+
+
+class Tracklist:
+    """ the records of the tracks in the order of the libvlc media list,
+        with a map from the media pointer to the index and the index of the
+        current track, so no lookup has to scan the media list. every change
+        of the media list has to be done here as well.
+
+        every change raises the version and is recorded as operation, the
+        operations since the last patch are taken with take_patch():
+            {"op": "insert", "index": int, "tracks": [records]}
+            {"op": "remove", "indices": [int, ...]}, removed one after another
+            {"op": "update", "tracks": [{"index": int, changed fields...}]}
+            {"op": "current", "index": int}
+            {"op": "clear"}
+
+        the content version only counts the changes of the tracks, so the
+        saved session is not rewritten when just the current track changes.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tracks = []   # the records {"index", "artist", "title", "mrl", "duration"}
+        self.keys = []     # the media pointer of each track
+        self.indices = {}  # media pointer: index
+        self.current = -1
+        self.version = 0
+        self.content_version = 0
+        self.ops = []
+        self.ops_from = 0
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def append(self, media, track):
+        """ append a track, the index of the record is set.
+            return: the index of the track.
+        """
+        with self.lock:
+            index = len(self.tracks)
+            key = media_key(media)
+            track["index"] = index
+            self.tracks.append(track)
+            self.keys.append(key)
+            self.indices[key] = index
+            self.content_version += 1
+            last = self.ops[-1] if self.ops else None
+            if (last and last["op"] == "insert" and
+                    last["index"] + len(last["tracks"]) == index):
+                last["tracks"].append(track)
+                self.version += 1
+            else:
+                self._change({"op": "insert", "index": index, "tracks": [track]})
+            return index
+
+    def remove(self, index):
+        """ remove the track at index, the following tracks move up
+        """
+        self.remove_many([index])
+
+    def remove_many(self, indices):
+        """ remove the tracks at the indices in one pass, the following
+            tracks move up.
+            args:
+                indices(list): the indices, sorted from high to low.
+            return: the media pointers of the removed tracks.
+        """
+        with self.lock:
+            if not indices:
+                return []
+            removed = set(indices)
+            first = min(removed)
+            keys = [self.keys[i] for i in indices]
+            for key in keys:
+                del self.indices[key]
+            tail = [i for i in range(first, len(self.tracks)) if i not in removed]
+            self.tracks[first:] = [self.tracks[i] for i in tail]
+            self.keys[first:] = [self.keys[i] for i in tail]
+            for i in range(first, len(self.tracks)):
+                self.tracks[i]["index"] = i
+                self.indices[self.keys[i]] = i
+            self.content_version += 1
+            if self.current in removed:
+                self.current = -1
+            elif self.current > first:
+                self.current -= sum(1 for i in indices if i < self.current)
+            last = self.ops[-1] if self.ops else None
+            if last and last["op"] == "remove":
+                last["indices"].extend(indices)
+                self.version += len(indices)
+            else:
+                self._change({"op": "remove", "indices": list(indices)})
+                self.version += len(indices) - 1
+            return keys
+
+    def clear(self):
+        """ remove all tracks
+        """
+        with self.lock:
+            self.tracks = []
+            self.keys = []
+            self.indices = {}
+            self.current = -1
+            self.content_version += 1
+            self.ops = []
+            self._change({"op": "clear"})
+
+    def update(self, index, fields):
+        """ change fields of the record at index
+        """
+        with self.lock:
+            track = self.get(index)
+            if track is None:
+                return
+            track.update(fields)
+            self.content_version += 1
+            change = dict(fields, index=index)
+            last = self.ops[-1] if self.ops else None
+            if last and last["op"] == "update":
+                last["tracks"].append(change)
+                self.version += 1
+            else:
+                self._change({"op": "update", "tracks": [change]})
+
+    def _change(self, op):
+        self.version += 1
+        self.ops.append(op)
+
+    def _set_current(self, index):
+        if index == self.current:
+            return
+        self.current = index
+        last = self.ops[-1] if self.ops else None
+        if last and last["op"] == "current":
+            last["index"] = index
+            self.version += 1
+        else:
+            self._change({"op": "current", "index": index})
+
+    def take_patch(self):
+        """ return: the operations since the last patch as dict
+                    {"from": version, "version": version, "ops": [...]},
+                    or None if nothing has changed.
+        """
+        with self.lock:
+            if not self.ops:
+                return None
+            patch = {"from": self.ops_from,
+                     "version": self.version,
+                     "ops": self.ops}
+            self.ops = []
+            self.ops_from = self.version
+            return patch
+
+    def snapshot(self):
+        """ return: a tuple (version, tracks) of the whole tracklist
+        """
+        with self.lock:
+            return self.version, list(self.tracks)
+
+    def content_snapshot(self):
+        """ return: a tuple (content version, tracks) of the whole tracklist
+        """
+        with self.lock:
+            return self.content_version, list(self.tracks)
+
+    def range(self, offset=0, limit=None, around=None):
+        """ return: a part of the tracklist as dict {"total": int,
+                    "version": int, "offset": int, "tracks": [records]}.
+            args:
+                offset(int): the index of the first track.
+                limit(int): the maximum number of tracks, or all.
+                around(int): if set, the tracks from around before to around
+                             after the current track, offset and limit are
+                             ignored.
+        """
+        with self.lock:
+            total = len(self.tracks)
+            if around is not None:
+                around = max(0, around)
+                offset = max(0, self.current - around) if self.current >= 0 else 0
+                limit = 2 * around + 1
+            offset = min(max(0, offset), total)
+            end = total if limit is None else min(total, offset + max(0, limit))
+            return {"total": total,
+                    "version": self.version,
+                    "offset": offset,
+                    "tracks": self.tracks[offset:end]}
+
+    def index_of(self, media):
+        """ return: the index of the media, or -1 if it is not in the tracklist
+        """
+        return self.index_of_key(media_key(media))
+
+    def index_of_key(self, key):
+        """ return: the index of the media pointer, or -1
+        """
+        return self.indices.get(key, -1)
+
+    def key_at(self, index):
+        """ return: the media pointer of the track at index, or None
+        """
+        if 0 <= index < len(self.keys):
+            return self.keys[index]
+        return None
+
+    def snapshot_keys(self):
+        """ return: the media pointers of all tracks in order
+        """
+        with self.lock:
+            return list(self.keys)
+
+    def get(self, index):
+        """ return: the record of the track at index, or None
+        """
+        if 0 <= index < len(self.tracks):
+            return self.tracks[index]
+        return None
+
+    def set_current(self, index):
+        """ set the index of the current track
+        """
+        with self.lock:
+            self._set_current(index if 0 <= index < len(self.tracks) else -1)
+
+    def set_current_media(self, media):
+        """ set the current track by its media
+        """
+        with self.lock:
+            self._set_current(self.index_of(media))
@@ -1,20 +1,20 @@
 # Author: Johan Hanssen Seferidis
 # License: MIT
 
+import collections
+import itertools
+import queue
 import re
-import sys
+import selectors
+import socket
 import struct
 import threading
 import time
+import zlib
 from base64 import b64encode
 from hashlib import sha1
 import logging
 
-if sys.version_info[0] < 3:
-    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
-else:
-    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
-
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 
@@ -35,6 +35,7 @@ logging.basicConfig()
 '''
 
 FIN    = 0x80
+RSV1   = 0x40
 OPCODE = 0x0f
 MASKED = 0x80
 PAYLOAD_LEN = 0x7f
@@ -82,18 +83,24 @@ class API():
     def set_fn_message_received(self, fn):
         self.message_received = fn
 
-    def send_message(self, client, msg):
-        self._unicast_(client, msg)
+    def send_message(self, client, msg, key=None):
+        self._unicast_(client, msg, key)
+
+    def send_binary(self, client, msg, key=None):
+        client['handler'].send_binary(msg, key)
 
-    def send_message_to_all(self, msg):
-        self._multicast_(msg)
+    def send_message_to_all(self, msg, key=None):
+        self._multicast_(msg, key)
 
 
 # ------------------------- Implementation -----------------------------
 
-class WebsocketServer(ThreadingMixIn, TCPServer, API):
+class WebsocketServer(API):
     """
-	A websocket server waiting for clients to connect.
+    A websocket server waiting for clients to connect. All clients are served
+    by one thread with a selector, the callbacks run in a pool of worker
+    threads, so a slow callback never blocks the network. The callbacks of one
+    client run one after another in order, different clients run in parallel.
 
     Args:
         port(int): Port to bind to
@@ -102,6 +109,17 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
             0.0.0.0.
         loglevel: Logging level from logging module to use for logging. By default
             warnings and errors are being logged.
+        timeout(int): Seconds without any data from a client until it is
+            disconnected.
+        max_backlog(int): Messages queued for a client until it is
+            disconnected, because it does not read them.
+        compress_threshold(int): Messages of at least this size in bytes are
+            compressed with permessage-deflate (RFC 7692), if the client
+            supports it. None disables the compression.
+        workers(int): Number of threads running the callbacks.
+
+    Messages with a key replace a queued message with the same key, that is
+    not sent yet, so a slow client only gets the latest state.
 
     Properties:
         clients(list): A list of connected clients. A client is a dictionary
@@ -113,19 +131,183 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
                 }
     """
 
-    allow_reuse_address = True
-    daemon_threads = True  # comment to keep threads alive until finished
-
-    clients = []
-    id_counter = 0
+    max_message_size = 1 << 24
 
-    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING):
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING, timeout=1800,
+                 max_backlog=500, compress_threshold=None, workers=4):
         logger.setLevel(loglevel)
         self.port = port
-        TCPServer.__init__(self, (host, port), WebSocketHandler)
+        self.timeout = timeout
+        self.max_backlog = max_backlog
+        self.compress_threshold = compress_threshold
+        self.workers = workers
+        self.counter = itertools.count()
+        self.stats = {'replaced': 0,     # queued messages replaced by a newer one
+                      'overflows': 0}    # clients disconnected on a full queue
+        self.clients = []
+        self.id_counter = 0
+        self.running = False
+        self.loop_thread = None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(16)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        # other threads wake up the selector by writing to the socketpair
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        self.lock = threading.Lock()
+        self.pending = set()  # handlers with queued messages
+        self.ready = queue.Queue()  # handlers with callbacks to run
+
+    def serve_forever(self):
+        self.running = True
+        self.loop_thread = threading.current_thread()
+        for _ in range(self.workers):
+            threading.Thread(target=self._callback_worker_, daemon=True).start()
+        last_check = time.monotonic()
+        check_interval = max(1, min(60, self.timeout / 10))
+        try:
+            while self.running:
+                for key, mask in self.selector.select(timeout=check_interval):
+                    if key.fileobj is self.socket:
+                        self._accept_()
+                    elif key.fileobj is self.wakeup_recv:
+                        self._drain_wakeup_()
+                    else:
+                        handler = key.data
+                        if mask & selectors.EVENT_READ:
+                            handler.on_readable()
+                        if mask & selectors.EVENT_WRITE and not handler.closed:
+                            handler.on_writable()
+                self._flush_pending_()
+                now = time.monotonic()
+                if now - last_check >= check_interval:
+                    last_check = now
+                    self._close_idle_(now)
+        finally:
+            self._shutdown_()
+
+    def server_close(self):
+        """ stop the event loop, it closes all connections
+        """
+        self.running = False
+        self._wakeup_()
+
+    def _accept_(self):
+        try:
+            connection, address = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        connection.setblocking(False)
+        handler = WebSocketHandler(self, connection, address)
+        self.selector.register(connection, selectors.EVENT_READ, handler)
+
+    def _wakeup_(self):
+        try:
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            # a wake up is already pending
+            pass
+
+    def _drain_wakeup_(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _queue_(self, handler, opcode, message, key=None):
+        """ queue a message of any thread, it is framed and written by the
+            event loop when the socket is writable. a queued message with the
+            same key is replaced.
+        """
+        with self.lock:
+            if handler.closed or handler.overflow:
+                return
+            if key is None:
+                key = next(self.counter)
+            if key in handler.outbox:
+                # the newer message takes the place of the old one
+                self.stats['replaced'] += 1
+                handler.outbox[key] = (opcode, message)
+            elif len(handler.outbox) >= self.max_backlog:
+                logger.warning("Client does not read, %i messages queued." % len(handler.outbox))
+                self.stats['overflows'] += 1
+                handler.overflow = True
+                handler.outbox.clear()
+            else:
+                handler.outbox[key] = (opcode, message)
+            self.pending.add(handler)
+        if threading.current_thread() is not self.loop_thread:
+            self._wakeup_()
+
+    def _flush_pending_(self):
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        for handler in pending:
+            if handler.overflow:
+                handler.close()
+            elif not handler.closed:
+                handler.on_writable()
+
+    def _set_writable_(self, handler, writable):
+        events = selectors.EVENT_READ
+        if writable:
+            events |= selectors.EVENT_WRITE
+        if handler.events != events:
+            handler.events = events
+            self.selector.modify(handler.socket, events, handler)
+
+    def _close_idle_(self, now):
+        for handler in [key.data for key in self.selector.get_map().values()
+                        if isinstance(key.data, WebSocketHandler)]:
+            if now - handler.last_activity > self.timeout:
+                logger.info("Client timed out.")
+                handler.close(send_close=True)
+
+    def _shutdown_(self):
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, WebSocketHandler):
+                key.data.close()
+        for sock in (self.socket, self.wakeup_recv, self.wakeup_send):
+            sock.close()
+        self.selector.close()
+        for _ in range(self.workers):
+            self.ready.put(None)
+
+    def _callback_(self, handler, function, *args):
+        # a handler is in the ready queue only once, so its callbacks are run
+        # by one worker at a time and keep their order
+        with self.lock:
+            handler.callbacks.append((function, args))
+            if handler.callbacks_scheduled:
+                return
+            handler.callbacks_scheduled = True
+        self.ready.put(handler)
+
+    def _callback_worker_(self):
+        while True:
+            handler = self.ready.get()
+            if handler is None:
+                return
+            while True:
+                with self.lock:
+                    if not handler.callbacks:
+                        handler.callbacks_scheduled = False
+                        break
+                    function, args = handler.callbacks.popleft()
+                try:
+                    function(*args)
+                except Exception as e:
+                    logger.error(str(e), exc_info=True)
 
     def _message_received_(self, handler, msg):
-        self.message_received(self.handler_to_client(handler), self, msg)
+        self._callback_(handler, self.message_received, handler.client, self, msg)
 
     def _ping_received_(self, handler, msg):
         handler.send_pong(msg)
@@ -140,215 +322,297 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
             'handler': handler,
             'address': handler.client_address
         }
+        handler.client = client
         self.clients.append(client)
-        self.new_client(client, self)
+        self._callback_(handler, self.new_client, client, self)
 
     def _client_left_(self, handler):
-        client = self.handler_to_client(handler)
-        self.client_left(client, self)
+        client = handler.client
         if client in self.clients:
             self.clients.remove(client)
+        self._callback_(handler, self.client_left, client, self)
 
-    def _unicast_(self, to_client, msg):
-        to_client['handler'].send_message(msg)
+    def _unicast_(self, to_client, msg, key=None):
+        to_client['handler'].send_message(msg, key)
 
-    def _multicast_(self, msg):
-        for client in self.clients:
-            self._unicast_(client, msg)
+    def _multicast_(self, msg, key=None):
+        for client in list(self.clients):
+            self._unicast_(client, msg, key)
+
+    def get_stats(self):
+        """ return: the counters of the queues and the queued messages of
+                    every client
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['queued'] = {client['id']: len(client['handler'].outbox)
+                               for client in self.clients}
+        stats['compression'] = {client['id']: client['handler'].get_compression_stats()
+                                for client in list(self.clients)}
+        return stats
 
     def handler_to_client(self, handler):
-        for client in self.clients:
-            if client['handler'] == handler:
-                return client
+        return handler.client
 
-class WebSocketHandler(StreamRequestHandler):
 
-    def __init__(self, socket, addr, server):
-        self.server = server
-        StreamRequestHandler.__init__(self, socket, addr, server)
+class WebSocketHandler():
+    """ one client connection. the buffers are only touched by the event loop,
+        other threads only append to the outbox through the server.
+    """
 
-    def setup(self):
-        StreamRequestHandler.setup(self)
-        self.keep_alive = True
+    def __init__(self, server, connection, address):
+        self.server = server
+        self.socket = connection
+        self.client_address = address
+        self.client = None
+        self.events = selectors.EVENT_READ
         self.handshake_done = False
-        self.valid_client = False
-        self.conn_alive = False
-        self.timeout = 1800                                         #MCH 30Min
-        self.timeout_client_stop = threading.Event()                #MCH
-        self.timeout_client = threading.Thread(target=self.timeout_client, args=[self.timeout_client_stop]).start() #MCH
-
-    def handle(self):
-        while self.keep_alive:
-            if not self.handshake_done:
-                self.handshake()
-            elif self.valid_client:
-                self.read_next_message()
-            self.conn_alive = True                                  #MCH
-
-    def timeout_client(self, stop_event):                           #MCH
-        count = 0                                                   #MCH
-        while not stop_event.is_set():                              #MCH
-            if count == self.timeout:                               #MCH
-                self.send_text("", opcode=OPCODE_CLOSE_CONN)        #MCH
-                self.finish()                                       #MCH
-                self.connection.close()                             #MCH
+        self.closed = False
+        self.closing = False
+        self.overflow = False
+        self.inbuf = bytearray()
+        self.fragments = None   # the payloads of an unfinished message
+        self.fragments_size = 0
+        self.fragments_header = 0
+        self.stream = None      # the frames of the message in progress
+        self.outbox = collections.OrderedDict()  # key: (opcode, message) not framed yet
+        self.callbacks = collections.deque()  # (function, args) not run yet
+        self.callbacks_scheduled = False
+        self.outbuf = bytearray()          # framed bytes not written yet
+        self.last_activity = time.monotonic()
+        self.deflate = None
+        self.payload_bytes = 0  # size of the sent messages
+        self.wire_bytes = 0     # size of the sent messages after compression
+
+    def on_readable(self):
+        try:
+            data = self.socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            logger.info("Client closed connection.")
+            return self.close()
+        self.last_activity = time.monotonic()
+        self.inbuf += data
+        if not self.handshake_done:
+            self.handshake()
+        if self.handshake_done:
+            self.read_messages()
+
+    def read_messages(self):
+        offset = 0
+        while not self.closed and not self.closing:
+            frame = read_frame(self.inbuf, offset)
+            if frame is None:
+                if len(self.inbuf) - offset > self.server.max_message_size:
+                    logger.warning("Message is too big.")
+                    self.close()
                 break
-            if self.conn_alive:                                     #MCH
-                self.conn_alive = False                             #MCH
-                count = 0                                           #MCH
-            count += 1                                              #MCH
-            time.sleep(1)                                           #MCH
-
-    def read_bytes(self, num):
-        # python3 gives ordinal of byte directly
-        try:                                                        #MCH
-            bytes = self.rfile.read(num)
-            if sys.version_info[0] < 3:
-                return map(ord, bytes)
-            else:
-                return bytes
-        except Exception:                                         #MCH
-            return                                                #MCH
+            b1, masked, payload, offset = frame
+            self.handle_frame(b1, masked, payload)
+        del self.inbuf[:offset]
 
-    def read_next_message(self):
-        try:
-            b1, b2 = self.read_bytes(2)
-        except ValueError as e:
-            b1, b2 = 0, 0
-        except TypeError as e:
-            b1, b2 = 0, 0
-            print(e)
-
-        fin    = b1 & FIN
+    def handle_frame(self, b1, masked, payload):
         opcode = b1 & OPCODE
-        masked = b2 & MASKED
-        payload_length = b2 & PAYLOAD_LEN
-
-        if not b1:
-            logger.info("Client closed connection.")
-            self.keep_alive = 0
-            return
         if opcode == OPCODE_CLOSE_CONN:
             logger.info("Client asked to close connection.")
-            self.keep_alive = 0
-            return
+            return self.close(send_close=True)
         if not masked:
-            logger.warn("Client must always be masked.")
-            self.keep_alive = 0
+            logger.warning("Client must always be masked.")
+            return self.close()
+        if opcode & 0x08:
+            # control frames may come between the fragments of a message
+            if not b1 & FIN or b1 & RSV1 or len(payload) > 125:
+                logger.warning("Invalid control frame.")
+                return self.close()
+            if opcode == OPCODE_PING:
+                self.server._ping_received_(self, payload)
+            elif opcode == OPCODE_PONG:
+                self.server._pong_received_(self, payload)
+            else:
+                logger.warning("Unknown opcode %#x." % opcode)
+                self.close()
             return
         if opcode == OPCODE_CONTINUATION:
-            logger.warn("Continuation frames are not supported.")
-            return
-        elif opcode == OPCODE_BINARY:
-            logger.warn("Binary frames are not supported.")
-            return
-        elif opcode == OPCODE_TEXT:
-            opcode_handler = self.server._message_received_
-        elif opcode == OPCODE_PING:
-            opcode_handler = self.server._ping_received_
-        elif opcode == OPCODE_PONG:
-            opcode_handler = self.server._pong_received_
+            if self.fragments is None or b1 & RSV1:
+                logger.warning("Unexpected continuation frame.")
+                return self.close()
+            self.fragments.append(payload)
+            self.fragments_size += len(payload)
+        elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            if self.fragments is not None:
+                logger.warning("New message before the last one was finished.")
+                return self.close()
+            if b1 & RSV1 and self.deflate is None:
+                logger.warning("Client sent a compressed frame without permessage-deflate.")
+                return self.close()
+            self.fragments = [payload]
+            self.fragments_size = len(payload)
+            self.fragments_header = b1
         else:
-            logger.warn("Unknown opcode %#x." + opcode)
-            self.keep_alive = 0
+            logger.warning("Unknown opcode %#x." % opcode)
+            return self.close()
+        if self.fragments_size > self.server.max_message_size:
+            logger.warning("Message is too big.")
+            return self.close()
+        if not b1 & FIN:
             return
+        payload = b"".join(self.fragments)
+        header = self.fragments_header
+        self.fragments = None
+        if header & RSV1:
+            try:
+                payload = self.deflate.decompress(payload)
+            except zlib.error:
+                logger.warning("Client sent an invalid compressed frame.")
+                return self.close()
+        if header & OPCODE == OPCODE_TEXT:
+            payload = try_decode_UTF8(payload)
+            if payload is False:
+                logger.warning("Text frame is not valid UTF-8.")
+                return self.close()
+        self.server._message_received_(self, payload)
+
+    def on_writable(self):
+        """ write as much as the socket takes, the queued messages are framed
+            only when the previous frames are written. of a message in chunks
+            only the next fragment is framed.
+        """
+        while True:
+            if not self.outbuf:
+                if self.stream is None:
+                    with self.server.lock:
+                        if not self.outbox:
+                            break
+                        key, (opcode, message) = self.outbox.popitem(last=False)
+                    self.stream = self.frames(opcode, message)
+                try:
+                    self.outbuf += next(self.stream)
+                except StopIteration:
+                    self.stream = None
+                    continue
+                except Exception as e:
+                    # the message is cut off, the connection can not be used anymore
+                    logger.error("Message could not be sent: %s" % e, exc_info=True)
+                    return self.close()
+            try:
+                sent = self.socket.send(self.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                return self.close()
+            del self.outbuf[:sent]
+            if self.outbuf:
+                break
+        if self.closing and not self.outbuf and not self.outbox and self.stream is None:
+            return self.close()
+        self.server._set_writable_(self, bool(self.outbuf or self.outbox or self.stream))
 
-        if payload_length == 126:
-            payload_length = struct.unpack(">H", self.rfile.read(2))[0]
-        elif payload_length == 127:
-            payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
-
-        masks = self.read_bytes(4)
-        decoded = ""
-        for char in self.read_bytes(payload_length):
-            char ^= masks[len(decoded) % 4]
-            decoded += chr(char)
-        opcode_handler(self, decoded)
-
-    def send_message(self, message):
-        self.send_text(message)
+    def frames(self, opcode, message):
+        """ yield the frames of a message. a message, that is not str or bytes,
+            is an iterable of chunks, every chunk is sent as one fragment.
+        """
+        if isinstance(message, (str, bytes)):
+            chunks = iter((message,))
+            compress = self.deflate is not None and not opcode & 0x08
+            threshold = self.server.compress_threshold
+        else:
+            chunks = iter(message)
+            compress = self.deflate is not None
+            threshold = 0
+        chunk = next(chunks, b"")
+        first = True
+        while chunk is not None:
+            # read one chunk ahead to know the last fragment
+            following = next(chunks, None)
+            payload = chunk if isinstance(chunk, bytes) else encode_to_UTF8(chunk)
+            if payload is False:
+                raise ValueError("chunk is not valid UTF-8")
+            final = following is None
+            if first:
+                compress = compress and (not final or len(payload) >= threshold)
+            rsv = RSV1 if compress and first else 0
+            self.payload_bytes += len(payload)
+            if compress:
+                payload = self.deflate.compress(payload, final)
+            self.wire_bytes += len(payload)
+            yield make_frame(payload, opcode if first else OPCODE_CONTINUATION, rsv, final)
+            first = False
+            chunk = following
+
+    def send_message(self, message, key=None):
+        self.send_text(message, key=key)
+
+    def send_binary(self, message, key=None):
+        self.send_text(message, OPCODE_BINARY, key)
 
     def send_pong(self, message):
         self.send_text(message, OPCODE_PONG)
 
-    def send_text(self, message, opcode=OPCODE_TEXT):
+    def send_text(self, message, opcode=OPCODE_TEXT, key=None):
         """
-        Important: Fragmented(=continuation) messages are not supported since
-        their usage cases are limited - when we don't know the payload length.
+        The message is a string, bytes or an iterable of them, e.g. a
+        generator. An iterable is sent fragmented, one chunk per frame, and it
+        is read only as fast as the client receives it.
         """
 
         # Validate message
         if isinstance(message, bytes):
-            message = try_decode_UTF8(message)  # this is slower but ensures we have UTF-8
-            if not message:
+            if opcode == OPCODE_TEXT and try_decode_UTF8(message) is False:
                 logger.warning("Can\'t send message, message is not valid UTF-8")
                 return False
-        elif sys.version_info < (3,0) and (isinstance(message, str) or isinstance(message, unicode)):
-            pass
-        elif isinstance(message, str):
-            pass
-        else:
-            logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
+        elif not isinstance(message, str) and not hasattr(message, '__iter__'):
+            logger.warning('Can\'t send message, message has to be a string, bytes or an iterable. Given type is %s' % type(message))
             return False
-
-        header  = bytearray()
-        payload = encode_to_UTF8(message)
-        payload_length = len(payload)
-
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
-
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
-
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
-
-        else:
-            raise Exception("Message is too big. Consider breaking it into chunks.")
-            return
-
-        try:                                            #MCH
-            self.request.send(header + payload)
-        except BrokenPipeError:                         #MCH
-            return                                      #MCH
+        self.server._queue_(self, opcode, message, key)
 
     def handshake(self):
-        message = self.request.recv(1024).decode().strip()
-        # print('--------------------------------------')
-        # print(dir(request))
-        # print('--------------------------------------')
-        upgrade = re.search('\nupgrade[\s]*:[\s]*websocket', message.lower())
-        if not upgrade:
-            self.keep_alive = False
+        end = self.inbuf.find(b"\r\n\r\n")
+        if end == -1:
+            if len(self.inbuf) > 8192:
+                self.close()
             return
-        key = re.search('\n[sS]ec-[wW]eb[sS]ocket-[kK]ey[\s]*:[\s]*(.*)\r\n', message)
+        message = self.inbuf[:end + 4].decode("latin-1")
+        del self.inbuf[:end + 4]
+        upgrade = re.search(r'\nupgrade[\s]*:[\s]*websocket', message.lower())
+        if not upgrade:
+            return self.close()
+        key = re.search(r'\n[sS]ec-[wW]eb[sS]ocket-[kK]ey[\s]*:[\s]*(.*)\r\n', message)
         if key:
             key = key.group(1)
         else:
             logger.warning("Client tried to connect but was missing a key")
-            self.keep_alive = False
-            return
-        response = self.make_handshake_response(key)
-        self.handshake_done = self.request.send(response.encode())
-        self.valid_client = True
+            return self.close()
+        extension = None
+        if self.server.compress_threshold is not None:
+            offers = re.search(r'\n[sS]ec-[wW]eb[sS]ocket-[eE]xtensions[\s]*:[\s]*(.*)\r\n', message)
+            if offers:
+                self.deflate, extension = PerMessageDeflate.negotiate(offers.group(1))
+        response = self.make_handshake_response(key, extension)
+        self.outbuf += response.encode()
+        self.handshake_done = True
         self.server._new_client_(self)
+        self.on_writable()
 
-    def make_handshake_response(self, key):
+    def make_handshake_response(self, key, extension=None):
         return \
           'HTTP/1.1 101 Switching Protocols\r\n'\
           'Upgrade: websocket\r\n'              \
           'Connection: Upgrade\r\n'             \
           'Sec-WebSocket-Accept: %s\r\n'        \
-          '\r\n' % self.calculate_response_key(key)
+          '%s'                                  \
+          '\r\n' % (self.calculate_response_key(key),
+                    'Sec-WebSocket-Extensions: %s\r\n' % extension if extension else '')
+
+    def get_compression_stats(self):
+        """ return: the compression of the sent messages of this client
+        """
+        return {'deflate': self.deflate is not None,
+                'payload': self.payload_bytes,
+                'sent': self.wire_bytes,
+                'ratio': round(self.payload_bytes / self.wire_bytes, 2) if self.wire_bytes else None}
 
     def calculate_response_key(self, key):
         GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
@@ -356,9 +620,161 @@ class WebSocketHandler(StreamRequestHandler):
         response_key = b64encode(hash.digest()).strip()
         return response_key.decode('ASCII')
 
-    def finish(self):
-        self.server._client_left_(self)
-        self.timeout_client_stop.set()                              #MCH
+    def close(self, send_close=False):
+        """ close the connection. with send_close the close frame and the
+            queued messages are written first.
+        """
+        if self.closed:
+            return
+        if send_close and not self.closing and self.handshake_done:
+            self.closing = True
+            with self.server.lock:
+                self.outbox[next(self.server.counter)] = (OPCODE_CLOSE_CONN, b"")
+            return self.on_writable()
+        self.closed = True
+        try:
+            self.server.selector.unregister(self.socket)
+        except (KeyError, ValueError):
+            pass
+        self.socket.close()
+        if self.client is not None:
+            self.server._client_left_(self)
+
+
+class PerMessageDeflate():
+    """ the permessage-deflate extension (RFC 7692) of one connection. the
+        compression context is kept between the messages, unless the client
+        asks for server_no_context_takeover.
+    """
+
+    def __init__(self, server_window_bits=15, server_takeover=True):
+        self.window_bits = server_window_bits
+        self.takeover = server_takeover
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                           -self.window_bits)
+        self.decompressor = zlib.decompressobj(-15)
+
+    @classmethod
+    def negotiate(cls, offers):
+        """ choose the first acceptable offer of the Sec-WebSocket-Extensions
+            header of the client.
+            return: a tuple (PerMessageDeflate, response header value), or
+                    (None, None) if nothing fits.
+        """
+        for offer in offers.split(","):
+            params = [param.strip() for param in offer.split(";")]
+            if params[0] != "permessage-deflate":
+                continue
+            window_bits = 15
+            takeover = True
+            response = ["permessage-deflate"]
+            try:
+                for param in params[1:]:
+                    name, _, value = param.partition("=")
+                    name, value = name.strip(), value.strip().strip('"')
+                    if name == "server_no_context_takeover":
+                        takeover = False
+                        response.append(name)
+                    elif name == "server_max_window_bits":
+                        window_bits = int(value)
+                        if not 9 <= window_bits <= 15:
+                            raise ValueError(value)
+                        response.append("%s=%i" % (name, window_bits))
+                    elif name not in ("client_no_context_takeover", "client_max_window_bits"):
+                        raise ValueError(name)
+            except ValueError:
+                continue
+            return cls(window_bits, takeover), "; ".join(response)
+        return None, None
+
+    def compress(self, payload, final=True):
+        """ compress a message, or a fragment of it if final is False
+        """
+        data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if not final:
+            return data
+        if not self.takeover:
+            self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                               -self.window_bits)
+        # the empty block of the sync flush is left out, see RFC 7692 7.2.1
+        return data[:-4] if data.endswith(b"\x00\x00\xff\xff") else data
+
+    def decompress(self, payload):
+        return self.decompressor.decompress(payload + b"\x00\x00\xff\xff")
+
+
+def read_frame(buffer, offset=0):
+    """ read the frame at offset of the buffer.
+        return: a tuple (first byte, masked, unmasked payload, offset behind
+                the frame), or None if the frame is not complete yet.
+    """
+    if len(buffer) < offset + 2:
+        return None
+    b1, b2 = buffer[offset], buffer[offset + 1]
+    masked = b2 & MASKED
+    payload_length = b2 & PAYLOAD_LEN
+    position = offset + 2
+    if payload_length == 126:
+        if len(buffer) < position + 2:
+            return None
+        payload_length = struct.unpack_from(">H", buffer, position)[0]
+        position += 2
+    elif payload_length == 127:
+        if len(buffer) < position + 8:
+            return None
+        payload_length = struct.unpack_from(">Q", buffer, position)[0]
+        position += 8
+    if masked:
+        masks = bytes(buffer[position:position + 4])
+        position += 4
+    if len(buffer) < position + payload_length:
+        return None
+    payload = bytes(buffer[position:position + payload_length])
+    if masked:
+        payload = unmask(payload, masks)
+    return b1, bool(masked), payload, position + payload_length
+
+
+def make_frame(payload, opcode=OPCODE_TEXT, rsv=0, fin=True):
+    """ return: the unmasked frame of the payload as bytes
+    """
+    header  = bytearray()
+    payload_length = len(payload)
+    b1 = (FIN if fin else 0) | rsv | opcode
+
+    # Normal payload
+    if payload_length <= 125:
+        header.append(b1)
+        header.append(payload_length)
+
+    # Extended payload
+    elif payload_length >= 126 and payload_length <= 65535:
+        header.append(b1)
+        header.append(PAYLOAD_LEN_EXT16)
+        header.extend(struct.pack(">H", payload_length))
+
+    # Huge extended payload
+    elif payload_length < 18446744073709551616:
+        header.append(b1)
+        header.append(PAYLOAD_LEN_EXT64)
+        header.extend(struct.pack(">Q", payload_length))
+
+    else:
+        raise Exception("Message is too big. Consider breaking it into chunks.")
+    return bytes(header) + payload
+
+
+def unmask(payload, masks):
+    """ unmask the payload with the 4 byte masking key. the payload and the
+        repeated key are XORed as two big integers, so the work is done in C
+        instead of a python loop per byte.
+    """
+    length = len(payload)
+    if not length:
+        return b""
+    key = (bytes(masks) * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^
+            int.from_bytes(key, "big")).to_bytes(length, "big")
 
 
 def encode_to_UTF8(data):
@@ -379,3 +795,30 @@ def try_decode_UTF8(data):
         return False
     except Exception as e:
         raise(e)
+
+
+if __name__ == "__main__":
+    # microbenchmark of the unmasking and decoding of received text frames:
+    # python3 websocket.py
+    import os
+    import timeit
+
+    def _unmask_per_byte(payload, masks):
+        # the former unmasking, to compare with
+        decoded = ""
+        for char in payload:
+            char ^= masks[len(decoded) % 4]
+            decoded += chr(char)
+        return decoded.encode("latin-1").decode("utf-8")
+
+    masks = os.urandom(4)
+    print("%10s %14s %14s" % ("size", "per byte", "bulk"))
+    for size in (1 << 10, 1 << 14, 1 << 17, 1 << 20):
+        text = ("pibox \u00e4\u00f6\u00fc " * (size // 10 + 1)).encode("utf-8")[:size]
+        text = text.decode("utf-8", "ignore").encode("utf-8")
+        payload = unmask(text, masks)
+        assert try_decode_UTF8(unmask(payload, masks)) == _unmask_per_byte(payload, masks)
+        number = max(1, (1 << 20) // size)
+        old = timeit.timeit(lambda: _unmask_per_byte(payload, masks), number=number) / number
+        new = timeit.timeit(lambda: try_decode_UTF8(unmask(payload, masks)), number=number) / number
+        print("%10i %11.3f ms %11.3f ms" % (len(payload), old * 1000, new * 1000))
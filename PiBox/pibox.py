@@ -46,6 +46,7 @@ import queue
 import json
 import collections
 import socket
+import struct
 import urllib.parse
 import logging
 
@@ -72,12 +73,21 @@ def hard_exit():
 def cleanup():
     """ cleanup before exit
     """
+    # the session first, so a failing shutdown below does not lose it
+    try:
+        mp.save_session(position=True)
+    except Exception as e:
+        print("| session save error: %s" % e, flush=True)
     try:
         lcd.clear()
         lcd.lcd_backlight(0)
         rotenc.clean()
         wss.close_server()
         https.close_server()
+        if hasattr(sy, "watcher"):
+            sy.watcher.close()
+        sy.stop_reading_tags()
+        sy.library.close()
         print("| cleaned up", flush=True)
     except Exception as e:
         print("| cleanup error: %s" % e, flush=True)
@@ -92,6 +102,12 @@ try:
     from lib import vlclib
     from lib import webserver
     from lib import websocket
+    from lib import library
+    from lib import inotify
+    from lib import parsescheduler
+    from lib import tracklist
+    from lib import shuffle
+    from lib import session
     # from lib import i2clcd
     # from lib import rotenc
 except Exception as e:
@@ -100,37 +116,54 @@ except Exception as e:
 
 """ load variables """
 config_file_path = os.path.join(os.path.dirname(__file__), "etc/config.json")
+""" default values """
+config = {
+    'pibox_name': "PiBox",                # Name for startscreen and site title (max 16 Chars)
+    'language': "en",                     # Language
+    'default_volume': 30,                 # Default Volume on startup (in %)
+    'force_softvol': False,               # Force PiBox to use Software Volume
+    'webserver_port': 8080,               # Webserver Port (ports below 1024 require root)
+    'websocket_port': 22222,              # Websocket Port
+    'theme_primary': "#000000",           # Standard PiBox Theme Primary Color
+    'theme_secondary': "#FFFFFF",         # Standard PiBox Theme Secondary Color
+    'theme_hover': "#808080",             # Standard PiBox Theme Hover Color
+    'pibox_home_dir': "home",             # PiBox Home directory (relativ to pibox directory)
+    'pibox_radio_dir': "Radio",           # PiBox Radio directory (relativ to home directory)
+    'pibox_playlist_dir': "Playlist",     # PiBox Playlist directory (relativ to home directory)
+    'file_extensions': [".mp3", ".MP3"],  # File extensions that insert in playlist
+    'random_per_directory': False,        # Pick random files equally from every directory
+    'directory_page_size': 100,           # Entries per directory page sent to the WebUI
+    'tracklist_page_size': 100,           # Tracks per range of the tracklist, if no limit is requested
+    'search_page_size': 50,               # Results per page of the library search
+    'position_interval': 1.0,             # Interval for position updates while playing (in s, 0=only on change)
+    'parse_workers': 2,                   # Number of tracks parsed by libvlc at the same time
+    'websocket_backlog': 500,             # Messages queued for a WebUI client until it is disconnected
+    'websocket_compress': 512,            # Compress messages to the WebUI from this size (in bytes, -1=never)
+    'broadcast_window': 0.03,             # Time to merge broadcasts to the WebUI (in s, 0=send immediately)
+    'metadata_window': 0.25,              # Time to collect parsed metadata before it is sent (in s)
+    'gapless_playback': False,            # Preload the next track on a second player to play without gaps
+    'gapless_preload': 5,                 # Time before the end of a track to preload the next one (in s)
+    'state_timeout': 2.0,                 # Maximum time the API waits for a change of the player state (in s)
+    'session_restore': True,              # Save the tracklist and playback state and restore it on startup
+    'session_interval': 10,               # Interval to save the changes of the session (in s)
+    'session_position_interval': 300,     # Interval to save only a changed playback position (in s)
+    'enable_lcd': False,                  # Enable LCD Display (True=enable, False=disable)
+    'lcd_i2c_addr': "0x27",               # LCD I2C Address
+    'lcd_row': 2,                         # LCD Rows
+    'lcd_col': 16,                        # LCD Columns
+    'display_timeout': 30,                # Timeout for Display Backlight (in s)
+    'menu_timeout': 30,                   # Timeout for Menu (in s)
+    'enable_re': False,                   # Enable Rotary Encoder (True=enable, False=disable)
+    'switch_clk': 17,                     # Rotary Encoder GPIO Pin Clock
+    'switch_dt': 27,                      # Rotary Encoder GPIO Pin Direction
+    'switch_sw': 22,                      # Rotary Encoder GPIO Pin Switch
+    'longpress_delay': 1.0                # Delay for Longpress event(in s)
+}
 try:
     with open(config_file_path, "r", encoding="utf-8-sig") as config_file:
-        config = json.load(config_file)
+        config.update(json.load(config_file))
 except OSError as e:
-    """ default values """
-    config = {
-        'pibox_name': "PiBox",                # Name for startscreen and site title (max 16 Chars)
-        'language': "en",                     # Language
-        'default_volume': 30,                 # Default Volume on startup (in %)
-        'force_softvol': False,               # Force PiBox to use Software Volume
-        'webserver_port': 8080,               # Webserver Port (ports below 1024 require root)
-        'websocket_port': 22222,              # Websocket Port
-        'theme_primary': "#000000",           # Standard PiBox Theme Primary Color
-        'theme_secondary': "#FFFFFF",         # Standard PiBox Theme Secondary Color
-        'theme_hover': "#808080",             # Standard PiBox Theme Hover Color
-        'pibox_home_dir': "home",             # PiBox Home directory (relativ to pibox directory)
-        'pibox_radio_dir': "Radio",           # PiBox Radio directory (relativ to home directory)
-        'pibox_playlist_dir': "Playlist",     # PiBox Playlist directory (relativ to home directory)
-        'file_extensions': [".mp3", ".MP3"],  # File extensions that insert in playlist
-        'enable_lcd': False,                  # Enable LCD Display (True=enable, False=disable)
-        'lcd_i2c_addr': "0x27",               # LCD I2C Address
-        'lcd_row': 2,                         # LCD Rows
-        'lcd_col': 16,                        # LCD Columns
-        'display_timeout': 30,                # Timeout for Display Backlight (in s)
-        'menu_timeout': 30,                   # Timeout for Menu (in s)
-        'enable_re': False,                   # Enable Rotary Encoder (True=enable, False=disable)
-        'switch_clk': 17,                     # Rotary Encoder GPIO Pin Clock
-        'switch_dt': 27,                      # Rotary Encoder GPIO Pin Direction
-        'switch_sw': 22,                      # Rotary Encoder GPIO Pin Switch
-        'longpress_delay': 1.0                # Delay for Longpress event(in s)
-    }
+    pass
 default = {}
 default["pibox_dir"] = os.path.dirname(os.path.realpath(__file__))
 default["pibox_home_dir"] = os.path.join(default["pibox_dir"], config["pibox_home_dir"])
@@ -258,19 +291,20 @@ class HTTPServer(threading.Thread):
             mp.pause()
             req['response'] = mp.get_current("pause")
         elif cmd == "player_toggle_pause":
+            serial = mp.get_state_serial()
             mp.toggle_pause()
-            req['response'] = mp.get_current("toggle")
+            req['response'] = mp.get_current("toggle", since=serial)
         elif cmd == "player_stop":
             mp.fake_stop()
             req['response'] = mp.get_current("stop")
         elif cmd == "player_next":
+            serial = mp.get_state_serial()
             mp.next()
-            time.sleep(.1)
-            req['response'] = mp.get_current("play")
+            req['response'] = mp.get_current("play", since=serial)
         elif cmd == "player_previous":
+            serial = mp.get_state_serial()
             mp.previous()
-            time.sleep(.1)
-            req['response'] = mp.get_current("play")
+            req['response'] = mp.get_current("play", since=serial)
         elif cmd == "player_playback_mode":
             mp.toggle_playback_mode()
             req['response'] = {'playbackmode': mp.get_playback_mode()}
@@ -282,7 +316,6 @@ class HTTPServer(threading.Thread):
                                'duration': mp.get_duration()}
         elif cmd == "player_volume_up":
             mp.volume_up()
-            time.sleep(.1)
             req['response'] = {'volume': mp.get_volume(1)}
         elif cmd == "player_volume_down":
             mp.volume_down()
@@ -299,7 +332,15 @@ class HTTPServer(threading.Thread):
                 except ValueError:
                     req['response'] = "invalid"
         elif cmd == "tracklist_get":
-            req['response'] = {'tracklist': mp.get_tracklist()}
+            if not "data" in locals():
+                req['response'] = {'tracklist': mp.get_tracklist()}
+            elif isinstance(data, dict):
+                req['response'] = mp.get_tracklist_range(data)
+            elif isinstance(data, list) and len(data) == 2:
+                req['response'] = mp.get_tracklist_range({'offset': data[0],
+                                                          'limit': data[1]})
+            else:
+                req['response'] = mp.get_tracklist_range({'around': data})
         elif cmd == "tracklist_play_new":
             if "data" in locals():
                 mp.new_tracklist(data)
@@ -309,8 +350,9 @@ class HTTPServer(threading.Thread):
                 mp.parse_url(data)
                 req['response'] = {'tracklist': mp.get_tracklist()}
         elif cmd == "tracklist_add_random":
-            if "data" in locals() and len(data) == 3:
-                mp.add_randomly(data[0], int(data[1]), bool(int(data[2])))
+            if "data" in locals() and len(data) in (3, 4):
+                mp.add_randomly(data[0], int(data[1]), bool(int(data[2])),
+                                bool(int(data[3])) if len(data) == 4 else None)
                 req['response'] = {'tracklist': mp.get_tracklist()}
         elif cmd == "tracklist_play_index":
             if "data" in locals():
@@ -323,6 +365,15 @@ class HTTPServer(threading.Thread):
             req['response'] = {'remove index': mp.remove_index()}
         elif cmd == "tracklist_clear":
             mp.clear_tracklist()
+        elif cmd == "system_stats":
+            req['response'] = sy.get_stats()
+        elif cmd == "system_search":
+            if "data" in locals():
+                if isinstance(data, dict):
+                    req['response'] = {'search': sy.search(str(data.get("query", "")),
+                                                           int(data.get("offset", 0)))}
+                else:
+                    req['response'] = {'search': sy.search(str(data))}
         else:
             req['command'] = "invalid"
             req['response'] = "error"
@@ -343,11 +394,29 @@ class WSServer(threading.Thread):
     """ creates a websocket and handle the incoming messages
     """
     daemon = True
+    # broadcasts that only carry the latest state
+    state_commands = ("current", "position", "volume", "mode")
+    # the states in the binary position message
+    binary_states = ("stop", "play", "pause")
+    chunk_size = 16384
 
     def __init__(self, websocket_port):
         threading.Thread.__init__(self)
         self.websocket_port = websocket_port
-        self.server = websocket.WebsocketServer(self.websocket_port, host="")
+        self.server = websocket.WebsocketServer(self.websocket_port, host="",
+                                                max_backlog=config["websocket_backlog"],
+                                                compress_threshold=(config["websocket_compress"]
+                                                                    if config["websocket_compress"] >= 0
+                                                                    else None))
+        self.cursor_counter = 0
+        self.outbox = collections.OrderedDict()
+        self.outbox_lock = threading.Lock()
+        self.outbox_event = threading.Event()
+        self.stats = {'broadcasts': 0,  # messages given to send_to_all
+                      'coalesced': 0,   # messages merged into a pending one
+                      'sent': 0,        # messages sent after merging
+                      'frames': 0}      # frames written to all clients
+        threading.Thread(target=self.broadcast_loop, daemon=True).start()
         # self.start()
 
     def run(self):
@@ -379,8 +448,7 @@ class WSServer(threading.Thread):
         # else:
         #     self.send_message(client, {'cmd': "current",
         #                                'data': mp.get_current("stop")})
-        self.send_message(client, {'cmd': "tracklist",
-                                   'data': mp.get_tracklist()})
+        self.send_tracklist(client)
 
     def left_client(self, client, server):
         """ log if a client has left
@@ -393,7 +461,7 @@ class WSServer(threading.Thread):
     def on_message(self, client, server, message):
         """ handle the over websocket incomming messages
         """
-        message = json.loads(message.encode("latin-1").decode("utf-8"))
+        message = json.loads(message)
         if not "cmd" in message.keys():
             return False
         cmd = message['cmd']
@@ -402,9 +470,18 @@ class WSServer(threading.Thread):
             data = message['data']
         if cmd == "websocket_conn_alive":
             pass
+        elif cmd == "websocket_binary":
+            # the client receives the position as binary message
+            client['binary'] = bool(data)
         elif cmd == "system_get_directory":
-            req["cmd"] = "directory"
-            req["data"] = sy.parse_dir(data)
+            self.send_directory(client, sy.parse_dir(data))
+        elif cmd == "system_get_directory_page":
+            if client.get("listing") and client["listing"]["cursor"] == data["cursor"]:
+                req["cmd"] = "directory_page"
+                req["data"] = self.get_directory_page(client, int(data["offset"]))
+        elif cmd == "system_search":
+            req["cmd"] = "search"
+            req["data"] = sy.search(data["query"], int(data.get("offset", 0)))
         elif cmd == "system_change_config":
             sy.change_config(data)
         elif cmd == "system_save_m3u":
@@ -416,15 +493,13 @@ class WSServer(threading.Thread):
                 req["data"] = "toast.cantSaveList"
         elif cmd == "system_rename_m3u":
             if sy.rename_m3u(data[0], data[1]):
-                req["cmd"] = "directory"
-                req["data"] = sy.parse_dir(sy.current_dir)
+                self.send_directory(client, sy.parse_dir(client.get("directory", sy.current_dir)))
             else:
                 req["cmd"] = "toast"
                 req["data"] = "toast.cantRenameList"
         elif cmd == "system_delete_m3u":
             if sy.delete_m3u(data):
-                req["cmd"] = "directory"
-                req["data"] = sy.parse_dir(sy.current_dir)
+                self.send_directory(client, sy.parse_dir(client.get("directory", sy.current_dir)))
         elif cmd == "system_reload":
             lcd.lcd_backlight_active()
             sy.restart_script()
@@ -491,7 +566,7 @@ class WSServer(threading.Thread):
                 req["data"] = "toast.cantAdd"
         elif cmd == "tracklist_add_random":
             lcd.lcd_backlight_active()
-            if mp.add_randomly(data[0], data[1], data[2]):
+            if mp.add_randomly(*data[:4]):
                 req["cmd"] = "toast"
                 req["data"] = ("toast.addRandom", data[1], sy.beauty_path(data[0]))
             else:
@@ -501,8 +576,12 @@ class WSServer(threading.Thread):
             lcd.lcd_backlight_active()
             mp.play_index(int(data))
         elif cmd == "tracklist_update":
-            req["cmd"] = "tracklist"
-            req["data"] = mp.get_tracklist()
+            if "data" in locals() and isinstance(data, dict):
+                self.send_tracklist_range(client, data)
+            else:
+                self.send_tracklist(client)
+        elif cmd == "tracklist_visible":
+            mp.set_visible(int(data[0]), int(data[1]))
         elif cmd == "tracklist_remove_index":
             mp.remove_index(data)
         elif cmd == "tracklist_clear":
@@ -518,22 +597,170 @@ class WSServer(threading.Thread):
                 self.send_message(client, {'cmd': req["cmd"],
                                            'data': req["data"]})
 
+    def send_tracklist(self, client):
+        """ send the whole tracklist with its version to a client, the
+            following changes are sent to all clients as tracklist_patch
+        """
+        version, tracks = mp.get_tracklist_snapshot()
+        self.send_message(client, {'cmd': "tracklist",
+                                   'version': version,
+                                   'data': tracks}, chunked=True)
+
+    def send_tracklist_range(self, client, query):
+        """ send a part of the tracklist with the total count and version
+            to a client, see MediaPlayer.get_tracklist_range()
+        """
+        tracklist_range = mp.get_tracklist_range(query)
+        self.send_message(client, {'cmd': "tracklist_range",
+                                   'total': tracklist_range["total"],
+                                   'version': tracklist_range["version"],
+                                   'offset': tracklist_range["offset"],
+                                   'data': tracklist_range["tracks"]})
+
+    def send_directory(self, client, listing):
+        """ send the first page of a directory listing to a client, the
+            following pages are requested with system_get_directory_page
+        """
+        self.cursor_counter += 1
+        client["directory"] = listing["directory"]
+        client["listing"] = {'cursor': self.cursor_counter,
+                             'directory': listing["directory"],
+                             'content': listing["content"]}
+        self.send_message(client, {'cmd': "directory",
+                                   'data': self.get_directory_page(client, 0)})
+
+    def get_directory_page(self, client, offset):
+        """ return a page of the directory listing of a client, beginning at offset
+        """
+        listing = client["listing"]
+        size = config["directory_page_size"]
+        return {'directory': listing["directory"],
+                'cursor': listing["cursor"],
+                'offset': offset,
+                'total': len(listing["content"]),
+                'content': listing["content"][offset:offset + size]}
+
     def close_server(self):
         """ close the websocket server
         """
         self.server.server_close()
 
-    def send_message(self, client, message):
+    def send_message(self, client, message, chunked=False):
         """ send a JSON encoded message to a specific client
+            args:
+                chunked(bool): encode and send the message in fragments, for
+                               big messages
         """
+        if chunked:
+            return self.server.send_message(client, self._json_chunks(message))
         data = json.dumps(message, separators=(',',':'))
         self.server.send_message(client, data)
 
+    def _json_chunks(self, message):
+        """ yield the JSON encoded message in chunks of about chunk_size
+        """
+        chunk = []
+        size = 0
+        for part in json.JSONEncoder(separators=(',',':')).iterencode(message):
+            chunk.append(part)
+            size += len(part)
+            if size >= self.chunk_size:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk)
+
+    def _encode_position(self, progress):
+        """ return: the position message as 10 bytes: type (1), state,
+                    position and duration in ms
+        """
+        state = progress['state']
+        return struct.pack(">BBii", 1,
+                           self.binary_states.index(state) if state in self.binary_states else 0,
+                           progress.get('position', 0) or 0,
+                           progress.get('duration', 0) or 0)
+
     def send_to_all(self, message):
-        """ send a JSON encoded message to all connected clients
+        """ send a JSON encoded message to all connected clients. messages
+            within the broadcast window are merged by their command: the
+            latest state wins and tracklist patches are joined. a merged
+            message keeps the place of the first one, so the order of the
+            commands is kept.
+        """
+        if config["broadcast_window"] <= 0:
+            with self.outbox_lock:
+                self.stats['broadcasts'] += 1
+            return self._broadcast(message)
+        cmd = message.get('cmd')
+        with self.outbox_lock:
+            self.stats['broadcasts'] += 1
+            if cmd == "toast":
+                # every toast is shown
+                key = (cmd, self.stats['broadcasts'])
+            else:
+                key = cmd
+            pending = self.outbox.get(key)
+            if pending is not None:
+                self.stats['coalesced'] += 1
+                if cmd == "tracklist_patch":
+                    message = self._merge_patches(pending, message)
+            self.outbox[key] = message
+            self.outbox_event.set()
+
+    def _merge_patches(self, pending, message):
+        """ return: one tracklist patch of two consecutive patches
+        """
+        if pending['data']['version'] != message['data']['from']:
+            return message
+        return {'cmd': "tracklist_patch",
+                'data': {'from': pending['data']['from'],
+                         'version': message['data']['version'],
+                         'ops': pending['data']['ops'] + message['data']['ops']}}
+
+    def broadcast_loop(self):
+        """ send the pending broadcasts, after the broadcast window has passed
+            since the first of them
         """
+        while True:
+            self.outbox_event.wait()
+            time.sleep(config["broadcast_window"])
+            with self.outbox_lock:
+                self.outbox_event.clear()
+                messages = list(self.outbox.values())
+                self.outbox.clear()
+            for message in messages:
+                try:
+                    self._broadcast(message)
+                except Exception as e:
+                    print("| broadcast error: %s" % e, flush=True)
+
+    def _broadcast(self, message):
         data = json.dumps(message, separators=(',',':'))
-        self.server.send_message_to_all(data)
+        clients = len(self.server.clients)
+        # a newer state replaces the one still queued for a slow client
+        key = message['cmd'] if message['cmd'] in self.state_commands else None
+        if message['cmd'] == "position":
+            binary = self._encode_position(message['data'])
+            for client in list(self.server.clients):
+                if client.get('binary'):
+                    self.server.send_binary(client, binary, key)
+                else:
+                    self.server.send_message(client, data, key)
+        else:
+            self.server.send_message_to_all(data, key)
+        with self.outbox_lock:
+            self.stats['sent'] += 1
+            self.stats['frames'] += clients
+
+    def get_stats(self):
+        """ return the counters of the broadcasts
+        """
+        with self.outbox_lock:
+            stats = dict(self.stats)
+        stats['clients'] = len(self.server.clients)
+        stats.update(self.server.get_stats())
+        return stats
 
 
 class MediaPlayer():
@@ -547,62 +774,119 @@ class MediaPlayer():
         self.mlp = self.vlc.media_list_player_new()
         self.declare_volume_mixer()
         self.set_volume(default_volume)
-        self.mp.event_manager().event_attach(
-            vlclib.EventType.MediaPlayerEndReached, self.on_end_track)
-        self.mp.event_manager().event_attach(
-            vlclib.EventType.MediaPlayerPlaying, self.on_play)
-        self.mp.event_manager().event_attach(
-            vlclib.EventType.MediaPlayerPaused, self.on_pause)
-        self.mp.event_manager().event_attach(
-            vlclib.EventType.MediaPlayerStopped, self.on_stop)
-        self.mp.event_manager().event_attach(
-            vlclib.EventType.MediaPlayerAudioVolume, self.on_volume_change)
-        self.mp.event_manager().event_attach(
-            vlclib.EventType.MediaPlayerMediaChanged, self.on_track_change)
-        self.mlp.set_media_player(self.mp)
+        self.gapless = config["gapless_playback"]
+        self._attach_events(self.mp)
+        if self.gapless:
+            # the media list player would advance on its own at the end of a
+            # track, so the players are driven directly in gapless mode
+            self.standby = self.vlc.media_player_new()
+            self._attach_events(self.standby)
+        else:
+            self.standby = None
+            self.mlp.set_media_player(self.mp)
         self.mlp.set_media_list(self.ml)
+        self.preload = {"index": -1, "key": None, "ready": False}
+        self.preload_lock = threading.Lock()
+        self.gap_start = None
+        self.gaps = collections.deque(maxlen=50)
         self.paused = False
         self.stopped = False
+        self.state = "stop"
+        self.state_serial = 0
+        self.state_condition = threading.Condition()
+        self.visible = (0, 0)
+        self.parser = parsescheduler.ParseScheduler(
+            self._start_parse, self._stop_parse, config["parse_workers"])
+        self.parser.start()
         self.playback_mode = "normal"
-        self.tracklist = []
-        self.shuffle_list = []
+        self.tracklist = tracklist.Tracklist()
+        self.patch_timer = None
+        self.patch_lock = threading.Lock()
+        self.shuffle = shuffle.ShuffleOrder()
+        self.session = session.Session(os.path.join(default["pibox_dir"], "etc"),
+                                       config["session_position_interval"])
+        self.resume = None
+        self.position_event = threading.Event()
+        threading.Thread(target=self.position_ticker, daemon=True).start()
+        if config["session_restore"]:
+            threading.Thread(target=self.session_saver, daemon=True).start()
+
+    def _attach_events(self, player):
+        """ attach the event handlers to a player
+        """
+        events = ((vlclib.EventType.MediaPlayerEndReached, self.on_end_track),
+                  (vlclib.EventType.MediaPlayerPlaying, self.on_play),
+                  (vlclib.EventType.MediaPlayerPaused, self.on_pause),
+                  (vlclib.EventType.MediaPlayerStopped, self.on_stop),
+                  (vlclib.EventType.MediaPlayerAudioVolume, self.on_volume_change),
+                  (vlclib.EventType.MediaPlayerMediaChanged, self.on_track_change))
+        for event_type, handler in events:
+            player.event_manager().event_attach(
+                event_type, self._dispatch_event, player, handler)
+
+    def _dispatch_event(self, event, player, handler):
+        """ pass the event of the active player to the handler. the players
+            swap their roles in gapless mode, the standby player only reports
+            that the preloaded track is buffered
+        """
+        if player is self.mp:
+            handler(event)
+        elif event.type == vlclib.EventType.MediaPlayerPlaying:
+            threading.Thread(target=self._standby_ready, args=[player],
+                             daemon=True).start()
 
     def on_end_track(self, event):
         """ event handler that handle the next playing file based on
             the playback mode
         """
+        self.gap_start = time.monotonic()
+        self._set_state("stop")
+        if self.gapless:
+            return self._gapless_next()
         playback_mode = self.get_playback_mode()
-        next_index = self.get_index() + 1
         if playback_mode == "shuffle":
-            return self.do_shuffle("next")
+            next_index = self.get_next_index()
         elif playback_mode == "loop":
             return
-        elif next_index == self.ml.count():
+        else:
+            next_index = self.get_index() + 1
+        if next_index is None or next_index == self.ml.count():
             # end of tracklist reached
+            self.gap_start = None
             lcd.lcd_display_string("%s" % chr(1), 1, 0, 7)
             wss.send_to_all({'cmd': "current",
                              'data': self.get_current("stop")})
             self.update_tracklist()
         else:
             # play next track in list workaround, because of a bug if you delete indecies before current index
-            def next(next_index):
+            def next(next_index, since):
                 self.mlp.play()
-                for i in range(0, 1000):
-                    if self.mp.will_play():
-                        return self.play_index(next_index)
-                    time.sleep(.01)
-            threading.Thread(target=next, args=[next_index]).start()
+                self.wait_state(["play"], since)
+                self.play_index(next_index)
+            threading.Thread(target=next, args=[next_index, self.state_serial],
+                             daemon=True).start()
 
     def on_play(self, event):
         """ event handler that show play icon and current track title on
             display and send play informations to all websocket clients
         """
+        self._set_state("play")
+        if self.gap_start is not None:
+            self.gaps.append((time.monotonic() - self.gap_start) * 1000)
+            self.gap_start = None
+        if self.resume:
+            key, position = self.resume
+            self.resume = None
+            if key == tracklist.media_key(self.mp.get_media()):
+                threading.Thread(target=self.mp.set_time, args=[position],
+                                 daemon=True).start()
         lcd.lcd_display_string("%s" % chr(0), 1, 0, 7)
         if not lcd.menu_shown():
             lcd.lcd_display_string("%s" % self.get_title(), 2, 1)
         wss.send_to_all({'cmd': "current",
                          'data': self.get_current("play")})
         self.update_tracklist()
+        self.position_event.set()
         # self.paused = False
 
 
@@ -616,23 +900,26 @@ class MediaPlayer():
         #                  'data': self.get_current("pause")})
         # self.update_tracklist()
         # self.paused = True
-        pass
+        self._set_state("stop" if self.stopped else "pause")
 
     def on_stop(self, event):
         """ event handler that show stop icon and send stop to all
             websocket clients
         """
+        self._set_state("stop")
         lcd.lcd_backlight_active()
         lcd.lcd_display_string("%s" % chr(1), 1, 0, 7)
         wss.send_to_all({'cmd': "current",
                          'data': self.get_current("stop")})
         self.update_tracklist()
+        self.position_event.set()
 
     def on_track_change(self, event):
         """ event handler that update tracklist on display
         """
         # self.update_tracklist(ws_send=False)
-        pass
+        self.tracklist.set_current_media(self.mp.get_media())
+        threading.Thread(target=self._reprioritize_parsing, daemon=True).start()
 
     def play(self):
         """ send the play command in single thread to prevent hangs
@@ -643,7 +930,8 @@ class MediaPlayer():
             self.play_index(self.get_index())
             self.stopped = False
         self.paused = False
-        threading.Thread(target=self.mlp.play, daemon=True).start()
+        player = self.mp if self.gapless else self.mlp
+        threading.Thread(target=player.play, daemon=True).start()
 
     def pause(self):
         """ pause the playback
@@ -656,6 +944,7 @@ class MediaPlayer():
             wss.send_to_all({'cmd': "current",
                              'data': self.get_current("pause")})
             self.update_tracklist()
+            self.position_event.set()
 
     def is_paused(self):
         """ return: True if playback is paused
@@ -678,14 +967,18 @@ class MediaPlayer():
         """ fake stop function to prevent a dead end
         """
         lcd.lcd_backlight_active()
-        self.mp.set_pause(1)
-        self.mp.set_position(0.0)
+        self._cancel_preload()
+        self.gap_start = None
         self.paused = False
         self.stopped = True
+        self.mp.set_pause(1)
+        self.mp.set_position(0.0)
+        self._set_state("stop")
         lcd.lcd_display_string("%s" % chr(1), 1, 0, 7)
         wss.send_to_all({'cmd': "current",
                          'data': self.get_current("stop")})
         self.update_tracklist()
+        self.position_event.set()
 
     def next(self):
         """ play the next track based on playback mode
@@ -720,15 +1013,15 @@ class MediaPlayer():
             #     self.play_index(self.ml.count() - 1)
 
     def get_index(self, media=False):
-        """ return the title of track
+        """ return the index of track
             args:
                 media(instance): return the index of the track
                                  else of the current playing track
         """
         if media:
-            return self.ml.index_of_item(media)
+            return self.tracklist.index_of(media)
         else:
-            return self.ml.index_of_item(self.mp.get_media())
+            return self.tracklist.current
 
     def get_artist(self, index=-1):
         """ return the title of track
@@ -787,18 +1080,45 @@ class MediaPlayer():
     def get_state(self):
         """ return current player state
         """
-        if self.mlp.is_playing():
-            return "play"
-        elif self.is_paused():
-            return "pause"
-        else:
-            return "stop"
+        return self.state
 
-    def get_current(self, request=None):
+    def get_state_serial(self):
+        """ return: the number of state changes so far, to wait for the
+                    next change with wait_state()
+        """
+        return self.state_serial
+
+    def _set_state(self, state):
+        """ set the player state on the events of libvlc and wake up all
+            waiting threads
+        """
+        with self.state_condition:
+            self.state = state
+            self.state_serial += 1
+            self.state_condition.notify_all()
+
+    def wait_state(self, states, since=None, timeout=None):
+        """ wait until the player is in one of the states.
+            args:
+                states(list): the states to wait for.
+                since(int): only accept a state change after this serial.
+                timeout(float): seconds to wait at most, default state_timeout.
+            return: the state, it is not in states if the timeout expired
+        """
+        if timeout is None:
+            timeout = config["state_timeout"]
+        with self.state_condition:
+            self.state_condition.wait_for(
+                lambda: self.state in states and
+                (since is None or self.state_serial > since), timeout)
+            return self.state
+
+    def get_current(self, request=None, since=None):
         """ return current track informations
             args:
                 state(str): ("play", "pause", "stop", "load", "toggle")
                             return direct information based on state
+                since(int): wait for a state change after this serial
         """
         if request == "load":
             return {'state': "load"}
@@ -808,14 +1128,11 @@ class MediaPlayer():
         # elif request == "stop":
         #     return {'state': "stop"}
         elif request in ["play", "pause", "stop", "toggle"]:
-            state = request
             if request == "toggle":
                 search = ['play', 'pause']
             else:
                 search = [request]
-            while not state in search:
-                state = self.get_state()
-                time.sleep(.1)
+            state = self.wait_state(search, since)
         else:
             state = self.get_state()
         return {'state': state,
@@ -841,8 +1158,168 @@ class MediaPlayer():
         self.mp.set_position(position)
         wss.send_to_all({'cmd': "current",
                          'data': self.get_current()})
+        self.position_event.set()
         return self.get_position()
 
+    def get_progress(self):
+        """ return the compact playback progress of the current track
+        """
+        if self.tracklist_empty():
+            return {'state': "stop",
+                    'position': 0,
+                    'duration': 0}
+        return {'state': self.get_state(),
+                'position': self.get_time(),
+                'duration': self.get_duration()}
+
+    def position_ticker(self):
+        """ broadcast the playback progress to all websocket clients, in the
+            configured interval while playing and immediately on seek or state
+            change. the clients extrapolate the position between the updates,
+            so the load stays the same regardless of the connected clients
+        """
+        interval = config["position_interval"]
+        last_sent = 0
+        while True:
+            try:
+                timeout = None
+                if self.get_state() == "play":
+                    if interval > 0:
+                        timeout = interval
+                    if self.gapless:
+                        # look for the end of the track at least every second
+                        timeout = min(timeout or 1, 1)
+                changed = self.position_event.wait(timeout=timeout)
+                self.position_event.clear()
+                if self.gapless:
+                    self.check_preload()
+                now = time.monotonic()
+                if changed or (interval > 0 and now - last_sent >= interval * .9):
+                    last_sent = now
+                    if wss.server.clients:
+                        wss.send_to_all({'cmd': "position",
+                                         'data': self.get_progress()})
+            except Exception as e:
+                print("| position error: %s" % e, flush=True)
+                # do not spin if the error repeats
+                time.sleep(1)
+
+    """
+    gapless playback
+    """
+    def get_next_index(self):
+        """ return: the index of the track that follows the current one
+                    based on the playback mode, or None at the end of the
+                    tracklist
+        """
+        count = self.ml.count()
+        if count == 0:
+            return None
+        if self.get_playback_mode() == "shuffle":
+            index = self.tracklist.index_of_key(self.shuffle.peek())
+            return index if index != -1 else None
+        index = self.get_index() + 1
+        if index < count:
+            return index
+        elif self.get_playback_mode() == "loop":
+            return 0
+        return None
+
+    def check_preload(self):
+        """ preload the next track, if the current one ends within the
+            configured time
+        """
+        if self.get_state() != "play" or self.mp.get_media() is None:
+            return
+        remaining = self.mp.get_length() - self.mp.get_time()
+        if not 0 < remaining <= config["gapless_preload"] * 1000:
+            return
+        index = self.get_next_index()
+        if index is None:
+            return
+        media = self.ml.item_at_index(index)
+        if media is None or tracklist.media_key(media) == self.preload["key"]:
+            return
+        with self.preload_lock:
+            self.standby.stop()
+            self.preload = {"index": index,
+                            "key": tracklist.media_key(media),
+                            "ready": False}
+            self.standby.audio_set_mute(True)
+            self.standby.set_media(media)
+            self.standby.play()
+
+    def _standby_ready(self, player):
+        """ pause the preloaded track at its beginning, the buffers stay filled
+        """
+        player.set_pause(1)
+        player.set_time(0)
+        with self.preload_lock:
+            if (player is self.standby and
+                    tracklist.media_key(player.get_media()) == self.preload["key"]):
+                self.preload["ready"] = True
+
+    def _cancel_preload(self):
+        """ drop the preloaded track
+        """
+        if not self.gapless:
+            return
+        with self.preload_lock:
+            if self.preload["key"] is None:
+                return
+            self.preload = {"index": -1, "key": None, "ready": False}
+            self.standby.stop()
+
+    def _gapless_next(self):
+        """ switch to the preloaded track at the end of the current one, or
+            load the next track if it is not ready. runs in the callback of
+            the ending player, so only the other player is touched here
+        """
+        preload = self.preload
+        index = self.tracklist.index_of_key(preload["key"])
+        if not preload["ready"] or index == -1 or index != self.get_next_index():
+            return threading.Thread(target=self._gapless_fallback, daemon=True).start()
+        with self.preload_lock:
+            old, self.mp = self.mp, self.standby
+            self.standby = old
+            self.preload = {"index": -1, "key": None, "ready": False}
+        self.tracklist.set_current(index)
+        self.shuffle.set_current(preload["key"])
+        self.mp.audio_set_volume(old.audio_get_volume())
+        self.mp.audio_set_mute(False)
+        self.mp.set_pause(0)
+        threading.Thread(target=self._after_swap, args=[old, index],
+                         daemon=True).start()
+
+    def _after_swap(self, old, index):
+        old.stop()
+        self._reprioritize_parsing()
+
+    def _gapless_fallback(self):
+        """ play the next track without preloading
+        """
+        self._cancel_preload()
+        index = self.get_next_index()
+        if index is not None:
+            return self.play_index(index)
+        # end of tracklist reached
+        self.gap_start = None
+        lcd.lcd_display_string("%s" % chr(1), 1, 0, 7)
+        wss.send_to_all({'cmd': "current",
+                         'data': self.get_current("stop")})
+        self.update_tracklist()
+
+    def get_gap_stats(self):
+        """ return: the measured gaps between the end of a track and the
+                    start of the next one in ms
+        """
+        gaps = list(self.gaps)
+        return {'enabled': self.gapless,
+                'count': len(gaps),
+                'last': round(gaps[-1], 1) if gaps else None,
+                'average': round(sum(gaps) / len(gaps), 1) if gaps else None,
+                'max': round(max(gaps), 1) if gaps else None}
+
     """
     volume control
     """
@@ -930,10 +1407,10 @@ class MediaPlayer():
             if not volume % 5 == 0:
                 volume = int(round(volume/10)*10)
             if state == "off":
-                subprocess.Popen(['amixer', '-M', '-q', 'set', self.alsa_mixer, 'unmute'])
-                subprocess.Popen(['amixer', '-M', '-q', 'set', self.alsa_mixer, '%s%%' % str(volume)])
+                subprocess.call(['amixer', '-M', '-q', 'set', self.alsa_mixer, 'unmute'])
+                subprocess.call(['amixer', '-M', '-q', 'set', self.alsa_mixer, '%s%%' % str(volume)])
             else:
-                subprocess.Popen(['amixer', '-M', '-q', 'set', self.alsa_mixer, '%s%%' % str(volume)])
+                subprocess.call(['amixer', '-M', '-q', 'set', self.alsa_mixer, '%s%%' % str(volume)])
         return self.get_volume()
 
     def hw_volume_up(self, step=5):
@@ -954,7 +1431,7 @@ class MediaPlayer():
                 if volume > 100:
                     volume = 100
                 set_cmd = '%s%%' % str(volume)
-            subprocess.Popen(['amixer', '-M', '-q', 'set', self.alsa_mixer, set_cmd])
+            subprocess.call(['amixer', '-M', '-q', 'set', self.alsa_mixer, set_cmd])
         return self.get_volume()
 
     def hw_volume_down(self, step=5):
@@ -976,14 +1453,14 @@ class MediaPlayer():
             else:
                 set_cmd = 'mute'
                 volume = 0
-            subprocess.Popen(['amixer', '-M', '-q', 'set', self.alsa_mixer, set_cmd])
+            subprocess.call(['amixer', '-M', '-q', 'set', self.alsa_mixer, set_cmd])
         return self.get_volume()
 
     def hw_volume_mute(self):
         """ mute the hardware audio volume
             return: the hardware volume in percents (0 = mute, 100 = nominal / 0dB).
         """
-        subprocess.Popen(['amixer', '-M', '-q', 'set', self.alsa_mixer, 'toggle'])
+        subprocess.call(['amixer', '-M', '-q', 'set', self.alsa_mixer, 'toggle'])
         return self.get_volume()
 
     def sw_on_volume_change(self, event):
@@ -1066,23 +1543,34 @@ class MediaPlayer():
         """ get the current tracklist.
             return: the tracklist as a list of dicts.
         """
-        # tracklist = []
-        # for i in range(0, self.ml.count()):
-        #     tracklist.append({"index": i,
-        #                       "artist": self.get_artist(i),
-        #                       "title": self.get_title(i),
-        #                       "mrl": self.get_mrl(i),
-        #                       "duration": self.get_duration(i)})
-        return self.tracklist
+        return self.tracklist.tracks
+
+    def get_tracklist_snapshot(self):
+        """ get the current tracklist with its version.
+            return: a tuple (version, tracklist).
+        """
+        return self.tracklist.snapshot()
+
+    def get_tracklist_range(self, query):
+        """ return a part of the tracklist with the total count and version.
+                args:
+                    query(dict): {"offset": int, "limit": int} or
+                                 {"around": int} for the tracks around the
+                                 current track.
+        """
+        if "around" in query:
+            return self.tracklist.range(around=int(query["around"]))
+        return self.tracklist.range(int(query.get("offset", 0)),
+                                    int(query.get("limit", config["tracklist_page_size"])))
 
-    def reindex_tracklist(self):
-        """ reindex the current tracklist.
+    def send_tracklist_patch(self):
+        """ send the changes of the tracklist since the last patch to all
+            websocket clients
         """
-        for index in range(0, self.ml.count() - 1):
-            self.tracklist[index]["artist"] = self.get_artist(index)
-            self.tracklist[index]["title"] = self.get_title(index)
-            self.tracklist[index]["mrl"] = self.get_mrl(index)
-            self.tracklist[index]["duration"] = self.get_duration(index)
+        patch = self.tracklist.take_patch()
+        if patch:
+            wss.send_to_all({"cmd": "tracklist_patch",
+                             "data": patch})
 
     def tracklist_empty(self):
         """ check if tracklist is empty.
@@ -1090,46 +1578,132 @@ class MediaPlayer():
         """
         return False if self.ml.count() > 0 else True
 
-    def add_to_tracklist(self, url):
-        """ add file to tracklist.
+    def add_to_tracklist(self, urls, tags=None):
+        """ add files to tracklist. the whole batch is added under one lock
+            of the media list and the indices are counted up from its end.
+                args:
+                    urls(str): the complete url of the file, to add.
+                    urls(list): a list of complete urls, to add.
+                    tags(dict): the known tags {url: {"artist", "title",
+                                "duration"}}, default from the library.
+        """
+        if isinstance(urls, str):
+            urls = [urls]
+        if tags is None:
+            tags = sy.library.get_tags([url for url in urls
+                                        if not url.startswith(("http://", "https://"))])
+        current = self.get_index()
+        self.ml.lock()
+        try:
+            for url in urls:
+                media = self.vlc.media_new(url)
+                track = tags.get(url)
+                if track:
+                    title = track["title"] or os.path.basename(url)
+                    media.set_meta(vlclib.Meta.Title, title)
+                    if track["artist"]:
+                        media.set_meta(vlclib.Meta.Artist, track["artist"])
+                    record = {"artist": track["artist"],
+                              "title": title,
+                              "mrl": os.path.normpath(url),
+                              "duration": track["duration"]}
+                else:
+                    record = {"artist": None,
+                              "title": os.path.basename(url.rstrip("/")) or url,
+                              "mrl": url,
+                              "duration": -1}
+                self.ml.add_media(media)
+                index = self.tracklist.append(media, record)
+                self.shuffle.add(tracklist.media_key(media))
+                if not track or not track["duration"]:
+                    self.parser.submit(tracklist.media_key(media), media,
+                                       self._parse_priority(index, current))
+        finally:
+            self.ml.unlock()
+
+    def _parse_priority(self, index, current):
+        """ return the parse priority of the track at index, the lowest first:
+            the current track, the next tracks, the visible tracks and the rest.
+        """
+        if index == current:
+            return (0, 0)
+        if current < index <= current + 5:
+            return (1, index - current)
+        if self.visible[0] <= index <= self.visible[1]:
+            return (2, index)
+        return (3, index)
+
+    def _reprioritize_parsing(self):
+        """ update the priorities of the waiting parses, after the current
+            track or the visible tracks have changed
+        """
+        current = self.get_index()
+        priorities = {}
+        for key in self.parser.pending_keys():
+            index = self.tracklist.index_of_key(key)
+            if index != -1:
+                priorities[key] = self._parse_priority(index, current)
+        self.parser.set_priorities(priorities)
+
+    def set_visible(self, first, last):
+        """ set the range of tracks, that are visible on a client.
                 args:
-                    url(str): the complete url of the file, to add.
+                    first(int): the index of the first visible track.
+                    last(int): the index of the last visible track.
         """
-        self.ml.add_media(url)
-        media = self.ml.item_at_index(self.ml.count() - 1)
-        index = self.get_index(media)
-        self.tracklist.append({"index": index,
-                               "artist": self.get_artist(index),
-                               "title": self.get_title(index),
-                               "mrl": self.get_mrl(index),
-                               "duration": self.get_duration(index)})
+        self.visible = (first, last)
+        self._reprioritize_parsing()
+
+    def _start_parse(self, media):
+        """ start the parsing of media, called by the parse scheduler
+        """
+        media.event_manager().event_attach(
+            vlclib.EventType.MediaParsedChanged, self._media_parsed, media)
         if default["libvlc_version"] < 3:
             media.parse_async() # used from libvlc version < 3.0
         else:
             media.parse_with_options(vlclib.MediaParseFlag.do_interact, -1)
-        media.event_manager().event_attach(
-            vlclib.EventType.MediaParsedChanged, self._media_parsed, media)
+
+    def _stop_parse(self, media):
+        """ stop the parsing of media, called by the parse scheduler
+        """
+        if default["libvlc_version"] >= 3:
+            media.parse_stop() # only available in libvlc version >= 3.0
 
     def _media_parsed(self, event, media):
-        """ event handler that send the tracklist to all websocket clients,
-            if all tracks are parsed
+        """ event handler that write the parsed metadata to the tracklist,
+            the changes are sent to the websocket clients in windows
         """
+        self.parser.done(tracklist.media_key(media))
         index = self.get_index(media)
-        if index != -1:
-            self.tracklist[index]["artist"] = self.get_artist(index)
-            self.tracklist[index]["title"] = self.get_title(index)
-            self.tracklist[index]["mrl"] = self.get_mrl(index)
-            self.tracklist[index]["duration"] = self.get_duration(index)
-        if index == self.ml.count() - 1:
-            if default["libvlc_version"] < 3:
-                if not media.is_parsed(): # used from libvlc version < 3.0
-                    return
-            else:
-                if str(media.get_parsed_status()) != "MediaParsedStatus.done":
-                    return
-            self.reindex_tracklist()
-            wss.send_to_all({"cmd": "tracklist",
-                             "data": self.get_tracklist()})
+        track = self.tracklist.get(index)
+        if track is None:
+            return
+        fields = {"artist": vlclib.bytes_to_str(media.get_meta(vlclib.Meta.Artist)),
+                  "title": vlclib.bytes_to_str(media.get_meta(vlclib.Meta.Title))}
+        duration = media.get_duration()
+        if duration > 0:
+            fields["duration"] = duration
+        fields = {key: value for key, value in fields.items() if track.get(key) != value}
+        if fields:
+            self.tracklist.update(index, fields)
+            self.schedule_tracklist_patch()
+
+    def schedule_tracklist_patch(self):
+        """ send the tracklist patch after the metadata window, so the parse
+            results arriving meanwhile reach the clients as one patch
+        """
+        with self.patch_lock:
+            if self.patch_timer is None:
+                self.patch_timer = threading.Timer(config["metadata_window"],
+                                                   self._send_scheduled_patch)
+                self.patch_timer.daemon = True
+                self.patch_timer.start()
+
+    def _send_scheduled_patch(self):
+        with self.patch_lock:
+            self.patch_timer = None
+        self.send_tracklist_patch()
 
     def new_tracklist(self, url):
         """ delete the current tracklist and start a new one.
@@ -1141,37 +1715,31 @@ class MediaPlayer():
         wss.send_to_all({"cmd": "current",
                          "data": self.get_current("load")})
         self._clean_tracklist()
-        self.shuffle_list = []
         self.parse_url(url)
         self.play()
         return True
 
-    def add_randomly(self, url, count=5, clean=True):
+    def add_randomly(self, url, count=5, clean=True, per_directory=None):
         """ adds a count of random files to tracklist.
                 args:
                     url(str): the complete url to a directory, to shuffle.
                     count(int): the number of files to add.
                     clean(bool): clean the tracklist before add
+                    per_directory(bool): pick equally from every directory,
+                                         default from config
         """
-        filelist = []
-        for root, directories, files in os.walk(url):
-            for filename in files:
-                if filename.endswith(tuple(config["file_extensions"])):
-                    filelist.append(os.path.join(root, filename))
-            # break # uncomment break, for not recursive randomly add
+        if per_directory is None:
+            per_directory = config["random_per_directory"]
+        filelist = sy.get_random_files(url, int(count), per_directory)
         if len(filelist) == 0:
             return False
         if clean:
             self.fake_stop()
             self._clean_tracklist()
-        self.shuffle_list = []
         random.shuffle(filelist)
-        if count > len(filelist):
-            count = len(filelist)
-        for i in range(0, count):
-            self.add_to_tracklist(filelist[i])
+        self.add_to_tracklist(filelist)
         if self.get_index() + 1 == 0:
-            self.mp.set_media(self.ml.item_at_index(0))
+            self.set_media_index(0)
         self.update_tracklist()
         if not lcd.menu_shown():
             lcd.lcd_display_string("%s" % mp.get_title(), 2, 1)
@@ -1183,46 +1751,72 @@ class MediaPlayer():
                 args:
                     index(int): the specific index if set, or the current index.
                     index(list): a list of indecies, to remove.
-                    update(bool): if true(default) reread the tracklist.
+                    update(bool): if true(default) send the changes to all clients.
         """
-        if self.ml.count() == 1:
-            self.clear_tracklist()
-            return "empty tracklist"
         if isinstance(index, list):
-            for index in reversed(index):
-                self.remove_index(index, False)
-            self._reread_tracklist()
-            self.update_tracklist()
+            indices = index
         else:
             index = int(index)
-            current = self.get_index()
             if index == -1:
-                index = current
-            if current == index:
-                next = self.ml.item_at_index(current + 1)
-                first = self.ml.item_at_index(0)
-                if next:
-                    if self.mp.is_playing():
-                        self.play_index(current + 1)
-                    else:
-                        self.mp.set_media(next)
-                elif first:
-                    if self.mp.is_playing():
-                        self.play_index(0)
-                    else:
-                        self.mp.set_media(first)
-            self.ml.remove_index(int(index))
-            if update:
-                self._reread_tracklist()
-                self.update_tracklist()
-            return int(index)
+                index = self.get_index()
+            indices = [index]
+        indices = sorted({int(i) for i in indices if 0 <= int(i) < len(self.tracklist)},
+                         reverse=True)
+        if not indices:
+            return "invalid"
+        if len(indices) == len(self.tracklist):
+            self.clear_tracklist()
+            return "empty tracklist"
+        current = self.get_index()
+        if current in indices:
+            # continue with the next remaining track, or the first one
+            removed = set(indices)
+            remaining = [i for i in range(current + 1, len(self.tracklist)) if i not in removed]
+            if not remaining:
+                remaining = [i for i in range(current) if i not in removed]
+            if self.mp.is_playing():
+                self.play_index(remaining[0])
+            else:
+                self.set_media_index(remaining[0])
+        # remove from the end, so the indices in front stay valid
+        self.ml.lock()
+        try:
+            for i in indices:
+                self.ml.remove_index(i)
+        finally:
+            self.ml.unlock()
+        keys = self.tracklist.remove_many(indices)
+        self.parser.discard(keys)
+        for key in keys:
+            self.shuffle.remove(key)
+        if update:
+            self.update_tracklist()
+        if isinstance(index, list):
+            return indices
+        return index
 
     def play_index(self, index):
         """ play the index from tracklist.
                 args:
                     index(int): the specific index if set, or the zero index.
         """
-        self.mlp.play_item_at_index(index)
+        self._cancel_preload()
+        self.tracklist.set_current(index)
+        self.shuffle.set_current(self.tracklist.key_at(index))
+        if self.gapless:
+            self.mp.set_media(self.ml.item_at_index(index))
+            self.mp.play()
+        else:
+            self.mlp.play_item_at_index(index)
+
+    def set_media_index(self, index):
+        """ set the track at index as current track, without playing it.
+                args:
+                    index(int): the index of the track.
+        """
+        self._cancel_preload()
+        self.mp.set_media(self.ml.item_at_index(index))
+        self.tracklist.set_current(index)
 
     def restart_tracklist(self):
         """ restart the tracklist by playing index zero.
@@ -1233,13 +1827,12 @@ class MediaPlayer():
         """ remove all tracks from tracklist
         """
         count = self.ml.count()
-        if default["libvlc_version"] >= 3:
-            for i in range(count):
-                media = self.ml.item_at_index(i)
-                threading.Thread(target=media.parse_stop).start() # only available in libvlc version >= 3.0
+        self._cancel_preload()
+        self.parser.cancel()
         for i in range(count):
             self.ml.remove_index(0)
-        self.tracklist = []
+        self.tracklist.clear()
+        self.shuffle.clear()
 
     def clear_tracklist(self):
         """ stop playing and clear the tracklist.
@@ -1251,17 +1844,6 @@ class MediaPlayer():
         if not lcd.menu_shown():
             lcd.lcd_clear_line(2)
 
-    def _reread_tracklist(self):
-        """ reread the entire tracklist
-        """
-        self.tracklist = []
-        for i in range(0, self.ml.count()):
-            self.tracklist.append({"index": i,
-                                   "artist": self.get_artist(i),
-                                   "title": self.get_title(i),
-                                   "mrl": self.get_mrl(i),
-                                   "duration": self.get_duration(i)})
-
     def update_tracklist(self):
         """ update the tracklist on all display devices
         """
@@ -1274,8 +1856,7 @@ class MediaPlayer():
             lcd.lcd_display_string(" " * 9, 1, 0, 8)
         wss.send_to_all({"cmd": "current",
                          "data": self.get_current()})
-        wss.send_to_all({"cmd": "tracklist",
-                         "data": self.get_tracklist()})
+        self.send_tracklist_patch()
 
     def parse_url(self, url):
         """ parse the given url to add only playable files.
@@ -1283,29 +1864,116 @@ class MediaPlayer():
                     url(str): the complete url to a file or directory, to add.
                     url(list): a list of urls, to add.
         """
+        self.add_to_tracklist(self._collect_urls(url))
+        if self.get_index() + 1 == 0 and not self.tracklist_empty():
+            self.set_media_index(0)
+        self.update_tracklist()
+        return True
+
+    def _collect_urls(self, url):
+        """ return the playable files of the given url.
+                args:
+                    url(str): the complete url to a file or directory.
+                    url(list): a list of urls.
+        """
+        urls = []
         if isinstance(url, list):
             for file in url:
-                self.parse_url(file)
+                urls.extend(self._collect_urls(file))
         elif isinstance(url, str):
             if url.startswith(("http://", "https://")):
-                self.add_to_tracklist(url)
+                urls.append(url)
             elif os.path.isdir(url):
-                for root, directories, files in os.walk(url):
-                    for filename in sorted(files):
-                        if filename.endswith(tuple(config["file_extensions"])):
-                            self.add_to_tracklist(os.path.join(root, filename))
+                urls.extend(sy.get_files(url))
             elif os.path.isfile(url):
                 if url.endswith(tuple(config["file_extensions"])):
-                    self.add_to_tracklist(url)
+                    urls.append(url)
                 elif url.endswith(".m3u"):
-                    for file in sy.parse_m3u(url):
-                        self.add_to_tracklist(file["path"])
+                    urls.extend(file["path"] for file in sy.parse_m3u(url))
             else:
                 print("| cannot open file", flush=True)
-        if self.get_index() + 1 == 0:
-            self.mp.set_media(self.ml.item_at_index(0))
+        return urls
+
+    """
+    session handling
+    """
+    def get_session_state(self):
+        """ return: the playback state to restore on the next start
+        """
+        return {"index": self.get_index(),
+                "position": max(0, self.get_time()),
+                "state": self.get_state(),
+                "mode": self.get_playback_mode(),
+                "volume": self.get_volume()}
+
+    def save_session(self, position=False):
+        """ write the changes of the tracklist and the playback state
+            args:
+                position(bool): also write a state, where only the position
+                                changed, e.g. on exit.
+        """
+        if not config["session_restore"]:
+            return
+        version, tracks = self.tracklist.content_snapshot()
+        try:
+            self.session.save(version, tracks, self.get_session_state(), position)
+        except OSError as e:
+            print("| session save error: %s" % e, flush=True)
+
+    def session_saver(self):
+        """ save the session in the configured interval
+        """
+        while True:
+            time.sleep(config["session_interval"])
+            self.save_session()
+
+    def restore_session(self):
+        """ restore the tracklist and the playback state of the last session.
+            the saved records are used as tags, so the tracks are not parsed
+            again. files that are gone are skipped.
+        """
+        if not config["session_restore"]:
+            return
+        start = time.monotonic()
+        tracks, state = self.session.load()
+        if not tracks:
+            return
+        state = state or {}
+        saved_index = state.get("index", -1)
+        position = state.get("position", 0)
+        index = -1
+        urls = []
+        tags = {}
+        for i, track in enumerate(tracks):
+            url = track["mrl"]
+            if not url.startswith(("http://", "https://")) and not os.path.isfile(url):
+                if i == saved_index:
+                    position = 0
+                continue
+            if i <= saved_index:
+                index = len(urls)
+            urls.append(url)
+            if track["duration"] and track["duration"] > 0:
+                tags[url] = track
+        if not urls:
+            return
+        self.add_to_tracklist(urls, tags)
+        self.set_media_index(min(max(index, 0), len(urls) - 1))
+        for i in range(3):
+            if self.get_playback_mode() == state.get("mode", "normal"):
+                break
+            self.toggle_playback_mode()
+        if state.get("volume", -1) >= 0:
+            self.set_volume(state["volume"])
+        if position:
+            self.resume = (tracklist.media_key(self.mp.get_media()), position)
+        if state.get("state") == "play":
+            self.play_index(self.get_index())
+        else:
+            self.stopped = True
         self.update_tracklist()
-        return True
+        print("| session restored: %i tracks in %i ms" % (
+            len(urls), (time.monotonic() - start) * 1000), flush=True)
 
     """
     playback mode handling
@@ -1315,49 +1983,24 @@ class MediaPlayer():
             args:
                 direction("next", "prev"): shuffle based on direction
         """
-        def shuffle(direction):
-            # time.sleep(.1)
-            count = self.ml.count()
-            if count > 10:
-                max = 10
-            else:
-                max = count
-            if direction == "next":
-                if len(self.shuffle_list) == max:
-                    self.shuffle_list.pop()
-                for i in range(0, 10):
-                    next_index = random.randint(0, count-1)
-                    if not next_index in self.shuffle_list:
-                        break
-                self.shuffle_list.insert(0, next_index)
-                index = self.shuffle_list[0]
-            elif direction == "prev":
-                if len(self.shuffle_list) > 1:
-                    self.shuffle_list.pop(0)
-                    index = self.shuffle_list[0]
-                else:
-                    self.shuffle_list = []
-                    return self.do_shuffle("next")
-            else:
-                return False
-            if self.ml.item_at_index(index):
-                for i in range(0, 1000):
-                    if self.mp.will_play():
-                        return self.play_index(index)
-                    time.sleep(.01)
-                else:
-                    print("coud'nt shuffle")
-                    return self.do_shuffle(direction)
-            else:
-                self.shuffle_list.pop(0)
-                return self.do_shuffle(direction)
-        threading.Thread(target=shuffle, args=[direction]).start()
-        # threading.Thread(target=shuffle, args=[direction], daemon=True).start()
+        if direction == "next":
+            key = self.shuffle.next()
+        elif direction == "prev":
+            key = self.shuffle.prev()
+            if key is None:
+                key = self.shuffle.next()
+        else:
+            return False
+        index = self.tracklist.index_of_key(key)
+        if index == -1:
+            return False
+        self.play_index(index)
+        return True
 
     def toggle_playback_mode(self):
         """ loop through the playback modes in order shuffle > loop > normal
         """
-        self.shuffle_list = []
+        self._cancel_preload()
         if self.playback_mode == "shuffle":
             self.playback_mode = "loop"
             # self.mlp.set_playback_mode(vlclib.PlaybackMode.loop)
@@ -1368,6 +2011,8 @@ class MediaPlayer():
             lcd.lcd_display_string(" ", 1, 0, 6)
         else:
             self.playback_mode = "shuffle"
+            self.shuffle.reset(self.tracklist.snapshot_keys(),
+                               tracklist.media_key(self.mp.get_media()))
             self.mlp.set_playback_mode(vlclib.PlaybackMode.loop)
             lcd.lcd_display_string("%s" % chr(3), 1, 0, 6)
         wss.send_to_all({"cmd": "mode",
@@ -1385,6 +2030,16 @@ class System():
     """
     def __init__(self):
         self.current_dir = default["pibox_home_dir"]
+        self.m3u_cache = collections.OrderedDict()
+        self.m3u_cache_size = 256
+        self.m3u_cache_lock = threading.Lock()
+        self.library = library.MediaLibrary(
+            os.path.join(default["pibox_dir"], "etc/library.db"),
+            default["pibox_home_dir"], config["file_extensions"])
+        self.tag_lock = threading.Lock()
+        self.library_indexed = threading.Event()
+        threading.Thread(target=self.index_library, daemon=True).start()
+        threading.Thread(target=self.watch_library, daemon=True).start()
         threading.Thread(target=self.check_wifi, daemon=True).start()
 
     # change config and save to file
@@ -1396,59 +2051,155 @@ class System():
         self.restart_script()
 
     # parse the given directory and return a json string
-    def parse_dir(self, url):
+    def parse_dir(self, url, remember=True):
         if not (os.path.isdir(url) and url.startswith(default["pibox_home_dir"])):
             url = default["pibox_home_dir"]
-        self.current_dir = url
+        if remember:
+            self.current_dir = url
         filelist = {"directory": url, "content": []}
         if not url == default["pibox_home_dir"]:
             filelist["content"].append({"type": "back",
                                         "url": url.rsplit("/", 1)[0],
                                         "name": "Return"})
         if url == default["pibox_radio_dir"]:
-            for root, directories, files in os.walk(url):
-                for file in sorted(files):
-                    if file.endswith(".m3u"):
-                        for station in self.parse_m3u(os.path.join(root, file)):
-                            filelist["content"].append({"type": "radio",
-                                                        "url": station["path"],
-                                                        "name": station["title"]})
+            for file in self.get_files(url, [".m3u"]):
+                for station in self.parse_m3u(file):
+                    filelist["content"].append({"type": "radio",
+                                                "url": station["path"],
+                                                "name": station["title"]})
         else:
-            for root, directories, files in os.walk(url):
-                count = 0
-                for dirname in sorted(directories):
-                    if not dirname.startswith("."):
-                        amount = os.listdir(os.path.join(root, dirname))
-                        if not amount == []:
-                            url = os.path.join(root, dirname)
-                            amount = len(amount)
-                            extra = {}
-                            count += 1
-                            filelist["content"].append({"type": "dir",
-                                                        "url": url,
-                                                        "name": dirname,
-                                                        "extra": extra})
-                for filename in sorted(files):
-                    url = os.path.join(root, filename)
-                    name = os.path.splitext(filename)[0]
+            directories, files = self.library.get_directory(url)
+            count = 0
+            for directory in directories:
+                if not directory["name"].startswith(".") and directory["entries"]:
                     extra = {}
-                    if filename.endswith(tuple(config["file_extensions"])):
-                        type = "file"
-                    elif filename.endswith(".m3u"):
-                        type = "playlist"
-                        amount = len(self.parse_m3u(os.path.join(root, filename)))
-                        extra["badge"] = amount
-                    else:
-                        continue
                     count += 1
-                    filelist["content"].append({"type": type,
-                                                "url": url,
-                                                "name": name,
+                    filelist["content"].append({"type": "dir",
+                                                "url": directory["path"],
+                                                "name": directory["name"],
                                                 "extra": extra})
-                if count == 0:
-                    filelist["content"].append({"type": "empty",
-                                                "name": "He's dead, Jim!"})
-                break
+            for file in files:
+                filename = file["name"]
+                name = os.path.splitext(filename)[0]
+                extra = {}
+                if filename.endswith(tuple(config["file_extensions"])):
+                    type = "file"
+                elif filename.endswith(".m3u"):
+                    type = "playlist"
+                    amount = len(self.parse_m3u(file["path"]))
+                    extra["badge"] = amount
+                else:
+                    continue
+                count += 1
+                filelist["content"].append({"type": type,
+                                            "url": file["path"],
+                                            "name": name,
+                                            "extra": extra})
+            if count == 0:
+                filelist["content"].append({"type": "empty",
+                                            "name": "He's dead, Jim!"})
+        return filelist
+
+    # return the runtime statistics
+    def get_stats(self):
+        return {'broadcast': wss.get_stats(),
+                'gapless': mp.get_gap_stats()}
+
+    # search the library, return a page of the results in the directory format
+    def search(self, query, offset=0):
+        total, files = self.library.search(query, offset, config["search_page_size"],
+                                           config["file_extensions"] + [".m3u"])
+        content = []
+        for file in files:
+            if file["name"].endswith(".m3u"):
+                type = "playlist"
+            else:
+                type = "file"
+            name = file["title"] or os.path.splitext(file["name"])[0]
+            if file["artist"]:
+                name = "%s - %s" % (file["artist"], name)
+            content.append({"type": type,
+                            "url": file["path"],
+                            "name": name,
+                            "extra": {}})
+        return {"query": query,
+                "offset": offset,
+                "total": total,
+                "content": content}
+
+    # update the library index and read the tags of new files for the search
+    def index_library(self):
+        start = time.time()
+        self.library.refresh()
+        self.library_indexed.set()
+        print("| library indexed in %.1fs" % (time.time() - start), flush=True)
+        self.read_missing_tags()
+
+    # read the tags of files, that were added to the library
+    def read_missing_tags(self):
+        if not self.tag_lock.acquire(blocking=False):
+            return
+        try:
+            start = time.time()
+            amount = self.library.read_missing_tags()
+            if amount:
+                print("| read tags of %i files in %.1fs" % (amount, time.time() - start),
+                      flush=True)
+        finally:
+            self.tag_lock.release()
+
+    # stop reading tags in the background and wait for the current batch
+    def stop_reading_tags(self):
+        self.library.stop_reading()
+        if self.tag_lock.acquire(timeout=10):
+            self.tag_lock.release()
+
+    # return count random playable files below the given directory
+    def get_random_files(self, url, count, per_directory=False):
+        if self.library.contains(url):
+            return self.library.sample_files(url, count, config["file_extensions"],
+                                             per_directory)
+        return library.reservoir_sample(library.iter_files(url, config["file_extensions"]),
+                                        count, per_directory)
+
+    # watch the home directory for changes, not available on every system
+    def watch_library(self):
+        try:
+            self.watcher = inotify.Watcher(default["pibox_home_dir"], self.on_library_change)
+        except Exception as e:
+            print("| library watcher not available: %s" % e, flush=True)
+            return
+        self.watcher.start()
+        # the stored directories are only trusted after the first full
+        # refresh, files added while PiBox was off are found by it
+        self.library_indexed.wait()
+        self.library.set_fn_is_watched(self.watcher.is_watched)
+
+    # update the library and the clients viewing one of the changed directories
+    def on_library_change(self, directories):
+        for directory in directories:
+            self.library.rescan(directory)
+        self.invalidate_m3u(directories)
+        threading.Thread(target=self.read_missing_tags, daemon=True).start()
+        affected = set(directories)
+        affected.update(directory.rsplit("/", 1)[0] for directory in directories)
+        if any(directory.startswith(default["pibox_radio_dir"]) for directory in directories):
+            affected.add(default["pibox_radio_dir"])
+        for client in list(wss.server.clients):
+            if client.get("directory") in affected:
+                wss.send_directory(client, self.parse_dir(client["directory"], False))
+
+    # return all playable files below the given directory, from the library index if possible
+    def get_files(self, url, extensions=None):
+        extensions = extensions or config["file_extensions"]
+        if self.library.contains(url):
+            return self.library.get_files(url, extensions)
+        filelist = []
+        for root, directories, files in os.walk(url):
+            directories.sort()
+            for filename in sorted(files):
+                if filename.endswith(tuple(extensions)):
+                    filelist.append(os.path.join(root, filename))
         return filelist
 
 
@@ -1459,25 +2210,55 @@ class System():
         return url.replace(default["pibox_home_dir"], config["pibox_name"])
 
     # parse a m3u file and return a list of dicts{"length","title","path"}
+    # the playlists are cached as long as their mtime and size are unchanged
     def parse_m3u(self, url):
+        try:
+            stat = os.stat(url)
+        except OSError:
+            return []
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.m3u_cache_lock:
+            cached = self.m3u_cache.get(url)
+            if cached and cached[0] == key:
+                self.m3u_cache.move_to_end(url)
+                return cached[1]
+        playlist = self._read_m3u(url)
+        with self.m3u_cache_lock:
+            self.m3u_cache[url] = (key, playlist)
+            self.m3u_cache.move_to_end(url)
+            while len(self.m3u_cache) > self.m3u_cache_size:
+                self.m3u_cache.popitem(last=False)
+        return playlist
+
+    # read a m3u file, invalid or unreadable files result in an empty playlist
+    def _read_m3u(self, url):
+        playlist = []
         try:
             with open(url, "r", encoding="utf-8-sig") as file:
                 line = file.readline()
                 if not line.startswith("#EXTM3U"):
-                    return
-                playlist = []
+                    return playlist
+                info = None
                 for line in file:
                     line = line.strip()
                     if line.startswith("#EXTINF:"):
-                        self.length, self.title = line.split("#EXTINF:")[1].split(",", 1)
+                        info = line.split("#EXTINF:")[1].split(",", 1)
                     elif (len(line) != 0):
-                        self.path = line
-                        playlist.append({"length": self.length,
-                                         "title": self.title,
-                                         "path": self.path})
-                return playlist
-        except OSError as e:
-            return
+                        length, title = info or ("-1", os.path.splitext(os.path.basename(line))[0])
+                        playlist.append({"length": length,
+                                         "title": title,
+                                         "path": line})
+                        info = None
+        except (OSError, ValueError):
+            pass
+        return playlist
+
+    # drop the cached playlists of the given directories
+    def invalidate_m3u(self, directories):
+        with self.m3u_cache_lock:
+            for url in [url for url in self.m3u_cache
+                        if url.rsplit("/", 1)[0] in directories]:
+                del self.m3u_cache[url]
 
     # create a m3u file out of the current playlist
     def create_m3u(self, file):
@@ -1494,11 +2275,11 @@ class System():
         except Exception:
             return
         file.write("#EXTM3U\n")
-        for i in range(0, mp.ml.count()):
+        for track in mp.get_tracklist():
             file.write("#EXTINF:%d,%s\n" % (
-                mp.get_duration(i),
-                mp.get_title(i)))
-            file.write("%s\n" % mp.get_mrl(i))
+                track["duration"],
+                track["title"]))
+            file.write("%s\n" % track["mrl"])
         file.close()
         return True
 
@@ -2207,6 +2988,7 @@ if __name__ == "__main__":
         wss = WSServer(config["websocket_port"])
         sy = System()
         mp = MediaPlayer(config["default_volume"])
+        mp.restore_session()
         if config["enable_lcd"]:
             lcd.start_screen()
             lcd.idle_screen()
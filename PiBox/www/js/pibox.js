@@ -17,6 +17,8 @@ function declareGlobVars() {
     window.globalCurrent = {};
     window.backupCurrent = {};
     window.progressInterval = undefined;
+    window.visibleTracksTimeout = undefined;
+    window.visibleTracks = '';
     window.volumeButtonHold = undefined;
     window.volumeButtonStep = undefined;
     window.directoryContent = [];
@@ -25,6 +27,10 @@ function declareGlobVars() {
         listClass: 'directory'
     });
     window.globalTracklist = [];
+    window.globalTracklistVersion = -1;
+    window.tracklistSegments = [];
+    window.tracklistSnapshotRequested = false;
+    window.markedTrack = undefined;
     window.backupTracklist = [];
     window.tracklistSearch = new List('tracklist', {
         valueNames: ['index', 'title'],
@@ -143,6 +149,7 @@ function initTranslation(lang, async=true) {
 function initWebsocket() {
     // initialize websocket
     window.websocket = new WebSocket("ws://"+globalData.own_ip+":"+globalData.websocket_port+"/");
+    websocket.binaryType = 'arraybuffer';
     websocket.onopen = function(){
         // websocket open
         console.log("%c>>> Websocket Server connected", logCSSSuccess);
@@ -155,10 +162,11 @@ function initWebsocket() {
             url = globalData.base_path;
         }
         sendCmd("system_get_directory", url);
+        sendCmd("websocket_binary", true);
     };
     websocket.onmessage = function(e){
         // receive message from websocket
-        var data = JSON.parse(e.data);
+        var data = (e.data instanceof ArrayBuffer) ? decodeBinary(e.data) : JSON.parse(e.data);
         // console.log(data);
         switch(data.cmd) {
             case "config":
@@ -167,12 +175,24 @@ function initWebsocket() {
             case "directory":
                 updateDirectory(data.data);
                 break;
+            case "directory_page":
+                appendDirectory(data.data);
+                break;
+            case "search":
+                updateSearch(data.data);
+                break;
             case "tracklist":
-                updateTracklist(data.data);
+                updateTracklist(data.data, data.version);
+                break;
+            case "tracklist_patch":
+                patchTracklist(data.data);
                 break;
             case "current":
                 updateCurrent(data.data);
                 break;
+            case "position":
+                updatePosition(data.data);
+                break;
             case "volume":
                 updateVolume(data.data);
                 break;
@@ -205,6 +225,23 @@ function initWebsocket() {
         }, 5000);
     };
 }
+function decodeBinary(buffer) {
+    // decode a binary message, the first byte is the type
+    let view = new DataView(buffer);
+    switch(view.getUint8(0)) {
+        case 1:
+            return {
+                cmd: 'position',
+                data: {
+                    state: ['stop', 'play', 'pause'][view.getUint8(1)],
+                    position: view.getInt32(2),
+                    duration: view.getInt32(6)
+                }
+            };
+        default:
+            return {cmd: 'unknown'};
+    }
+}
 function updateData(data) {
     // write received configuration to global data
     $.extend(globalData, data);
@@ -728,51 +765,11 @@ function updateDirectory(data) {
     clearMarks('directory');
     directoryContent = [];
     globalData.current_path = data.directory;
+    globalData.directory_cursor = data.cursor;
     pathDOM.html(createPath(data.directory));
     directoryDOM.empty();
     for (let index = 0; index < data.content.length; index++) {
-        let segment = data.content[index];
-        let settings = {
-            type: segment.type,
-            data: segment.url,
-            name: segment.name
-        }
-        if (segment.type == "back"){
-            settings.type = 'return';
-            settings.title = getTranslation('tooltip.return');
-            settings.name = getTranslation('misc.segmentReturn');
-            settings.icon = 'fa-chevron-circle-left';
-        } else if (segment.type == "empty"){
-            settings.title = getTranslation('tooltip.empty');
-            settings.name = getTranslation('misc.segmentEmpty');
-            settings.icon = 'fa-dizzy';
-        } else if (segment.type == "dir"){
-            settings.title = getTranslation('tooltip.open');
-            settings.icon = 'fa-folder';
-            if (globalData.current_path != globalData.base_path) {
-                settings.context = true;
-                settings.markable = true;
-            }
-        } else if (segment.type == "file"){
-            settings.title = getTranslation('tooltip.play');
-            settings.icon = 'fa-file-audio';
-            settings.command = 'tracklist_play_new';
-            settings.context = true;
-            settings.markable = true;
-        } else if (segment.type == "radio"){
-            settings.title = getTranslation('tooltip.play');
-            settings.icon = 'fa-podcast';
-            settings.command = 'tracklist_play_new';
-            settings.context = true;
-        } else if (segment.type == "playlist"){
-            settings.title = getTranslation('tooltip.play');
-            settings.icon = 'fa-file-alt';
-            settings.command = 'tracklist_play_new';
-            settings.badge = segment.extra.badge;
-            settings.context = true;
-        }
-        let element = createSegment(settings);
-        directoryContent.push(element);
+        directoryContent.push(createDirectorySegment(data.content[index]));
     }
     for (let i = 0; i < possibleSegments().total; i++) {
         directoryDOM.append(directoryContent[i]);
@@ -782,6 +779,78 @@ function updateDirectory(data) {
     if (directoryContent[0].properties.type == 'return' && checkMobile()) {
         backButtonHandling();  ////////////////////////////////////////////beta
     }
+    requestDirectoryPage(data);
+}
+function appendDirectory(data) {
+    // append a following page to the directory (folder view)
+    if (data.cursor != globalData.directory_cursor || data.offset != directoryContent.length) {
+        return;
+    }
+    for (let index = 0; index < data.content.length; index++) {
+        directoryContent.push(createDirectorySegment(data.content[index]));
+    }
+    if (directorySearch.searched) {
+        searchDirectory(directorySearch.lastSearch);
+    } else {
+        let shown = directoryDOM.children('.segment').length;
+        for (let i = shown; i < Math.min(possibleSegments().total, directoryContent.length); i++) {
+            directoryDOM.append(directoryContent[i]);
+        }
+    }
+    requestDirectoryPage(data);
+}
+function requestDirectoryPage(data) {
+    // request the next page of the directory in the background, if there is one
+    let offset = data.offset + data.content.length;
+    if (offset < data.total) {
+        sendCmd('system_get_directory_page', {
+            cursor: data.cursor,
+            offset: offset
+        });
+    }
+}
+function createDirectorySegment(segment) {
+    // create a directory segment out of a received directory entry
+    let settings = {
+        type: segment.type,
+        data: segment.url,
+        name: segment.name
+    }
+    if (segment.type == "back"){
+        settings.type = 'return';
+        settings.title = getTranslation('tooltip.return');
+        settings.name = getTranslation('misc.segmentReturn');
+        settings.icon = 'fa-chevron-circle-left';
+    } else if (segment.type == "empty"){
+        settings.title = getTranslation('tooltip.empty');
+        settings.name = getTranslation('misc.segmentEmpty');
+        settings.icon = 'fa-dizzy';
+    } else if (segment.type == "dir"){
+        settings.title = getTranslation('tooltip.open');
+        settings.icon = 'fa-folder';
+        if (globalData.current_path != globalData.base_path) {
+            settings.context = true;
+            settings.markable = true;
+        }
+    } else if (segment.type == "file"){
+        settings.title = getTranslation('tooltip.play');
+        settings.icon = 'fa-file-audio';
+        settings.command = 'tracklist_play_new';
+        settings.context = true;
+        settings.markable = true;
+    } else if (segment.type == "radio"){
+        settings.title = getTranslation('tooltip.play');
+        settings.icon = 'fa-podcast';
+        settings.command = 'tracklist_play_new';
+        settings.context = true;
+    } else if (segment.type == "playlist"){
+        settings.title = getTranslation('tooltip.play');
+        settings.icon = 'fa-file-alt';
+        settings.command = 'tracklist_play_new';
+        settings.badge = segment.extra.badge;
+        settings.context = true;
+    }
+    return createSegment(settings);
 }
 function createPath(path) {
     // create the path dom
@@ -893,6 +962,7 @@ function toggleReturnSegment(scrolltop) {
 }
 function searchDirectory(search) {
     // search in directory
+    directorySearch.lastSearch = search;
     toggleReturnSegment();
     directoryDOM.empty();
     for (let i = 0; i < directoryContent.length; i++) {
@@ -907,6 +977,71 @@ function searchDirectory(search) {
         directoryDOM.prepend(directoryContent[0]);
     }
 }
+function searchLibrary(query) {
+    // search in the whole library, the results are shown in the folder view
+    globalData.search = {
+        query: query,
+        total: 0,
+        requested: 0
+    };
+    sendCmd('system_search', {
+        query: query,
+        offset: 0
+    });
+}
+function updateSearch(data) {
+    // show a page of the library search results
+    let search = globalData.search;
+    if (!search || data.query != search.query) {
+        return;
+    }
+    search.total = data.total;
+    if (data.offset == 0) {
+        contentDOM.css('scroll-behavior', 'auto').scrollTop(0).removeAttr('style');
+        toggleReturnSegment();
+        clearSearchDirectory();
+        clearMarks('directory');
+        globalData.directory_cursor = undefined;
+        directoryContent = [createDirectorySegment({
+            type: 'back',
+            url: globalData.current_path
+        })];
+        if (data.total == 0) {
+            directoryContent.push(createDirectorySegment({type: 'empty'}));
+        }
+        directoryDOM.empty();
+        searchIconDOM.attr('title', getTranslation('tooltip.clearSearch'))
+                     .children('i').toggleClass('fa-search-minus');
+        searchBadgeDOM.text('"' + data.query + '" (' + data.total + ')').show();
+    } else if (data.offset != directoryContent.length - 1) {
+        return;
+    }
+    for (let index = 0; index < data.content.length; index++) {
+        directoryContent.push(createDirectorySegment(data.content[index]));
+    }
+    let shown = directoryDOM.children('.segment').length;
+    for (let i = shown; i < Math.min(possibleSegments().total, directoryContent.length); i++) {
+        directoryDOM.append(directoryContent[i]);
+    }
+    if (directoryContent.length <= possibleSegments().total) {
+        requestSearchPage();
+    }
+}
+function requestSearchPage() {
+    // request the next page of the library search results, if there is one
+    let search = globalData.search;
+    if (!search || searchBadgeDOM.text() == "") {
+        return;
+    }
+    let offset = directoryContent.length - 1;
+    if (offset < search.total && offset > search.requested) {
+        search.requested = offset;
+        sendCmd('system_search', {
+            query: search.query,
+            offset: offset
+        });
+    }
+}
 function clearSearchDirectory() {
     // clear and reset the file search
     if (searchBadgeDOM.text() != "") {
@@ -993,15 +1128,15 @@ function updateCurrent(data) {
                 settings.docTitle = '\u25B6 ' + title;
                 settings.buttonTitle = getTranslation('tooltip.pause');
                 settings.buttonIcon = 'fa-pause';
-                progressInterval = setTimeout(function() {
-                    sendCmd('player_get_current');
-                }, 100);
+                globalCurrent.positionTime = Date.now();
+                progressInterval = setTimeout(tickPosition, 250);
             };
             break;
         default:
             console.log('unkown state');
     }
     updateTitleInfo(settings);
+    markCurrentTrack();
     if (['play', 'pause'].includes(globalCurrent.state)) {
         if (globalCurrent.mrl != backupCurrent.mrl &&
             globalTracklist.length > 0 &&
@@ -1015,6 +1150,42 @@ function updateCurrent(data) {
         }
     }
 }
+function updatePosition(data) {
+    // update the position received from the server, extrapolated by tickPosition
+    if (!['play', 'pause'].includes(globalCurrent.state)) {
+        return;
+    }
+    if (data.state != globalCurrent.state) {
+        sendCmd('player_get_current');
+        return;
+    }
+    globalCurrent.position = data.position;
+    globalCurrent.duration = data.duration;
+    globalCurrent.positionTime = Date.now();
+    tickPosition();
+}
+function tickPosition() {
+    // show the extrapolated position of the current track between server updates
+    clearTimeout(progressInterval);
+    let position = globalCurrent.position;
+    if (globalCurrent.state === 'play') {
+        position += Date.now() - globalCurrent.positionTime;
+        if (globalCurrent.duration > 0) {
+            position = Math.min(position, globalCurrent.duration);
+        }
+        progressInterval = setTimeout(tickPosition, 250);
+    }
+    let time = getDuration(position);
+    if (positionDOM.text() != time) {
+        positionDOM.text(time);
+    }
+    if (globalCurrent.duration > 0) {
+        let progress = Math.floor((position * 100) / globalCurrent.duration);
+        progressDOM.val(progress / 100)
+                   .attr('value' , progress)
+                   .css('--progress', progress + '%');
+    }
+}
 function updateTitleInfo(settings) {
     // update the title informations
     let props = {
@@ -1074,10 +1245,11 @@ function updateTitleInfo(settings) {
     stateButtonIconDOM.removeAttr('class')
                       .addClass('fa fa-2x ' + props.buttonIcon);
 }
-function updateTracklist(tracklist) {
-    // update the tracklist
+function updateTracklist(tracklist, version) {
+    // update the whole tracklist
     globalTracklist = tracklist;
-    let totalDuration = 0;
+    globalTracklistVersion = version;
+    tracklistSnapshotRequested = false;
     let tracklistSearched = tracklistSearch.searched;
     let tracklistCheckedMarker = [];
     tracklistDOM.find('.mark').each(function(index, elem) {
@@ -1086,28 +1258,14 @@ function updateTracklist(tracklist) {
         }
     })
     tracklistListDOM.empty();
+    tracklistSegments = [];
     for (let index = 0; index < globalTracklist.length; index++) {
-        let segment = globalTracklist[index];
-        totalDuration += segment.duration;
-        let settings = {
-            mrl: segment.mrl,
-            data: segment.index,
-            index: segment.index,
-            artist: segment.artist,
-            title: segment.title,
-            duration: segment.duration,
-        }
-        if(segment.index == globalCurrent.index && globalCurrent.state != "stop"){
-            settings.state = 'playing';
-            if (globalCurrent.state == 'pause') {
-                settings.state += ' paused';
-            }
-        }
-        let element = createTracklistSegment(settings);
+        let element = createTracklistSegment(getTrackSettings(globalTracklist[index], index));
+        tracklistSegments.push(element);
         tracklistListDOM.append(element);
     }
-    tracklistBadgeDOM.text(globalTracklist.length);
-    tracklistListHeaderDurationDOM.text(getDuration(totalDuration));
+    markCurrentTrack();
+    updateTracklistSummary();
     if (globalTracklist.toString() == backupTracklist.toString() && tracklistCheckedMarker.length > 0) {
             let tracklistMarker = tracklistDOM.find('.mark');
             for (let i = 0; i < tracklistCheckedMarker.length; i++) {
@@ -1122,6 +1280,156 @@ function updateTracklist(tracklist) {
     }
     backupTracklist = globalTracklist;
 }
+function sendVisibleTracks() {
+    // report the range of visible tracks, so they are parsed first
+    clearTimeout(visibleTracksTimeout);
+    visibleTracksTimeout = setTimeout(function() {
+        if (!tracklistDOM.is(':visible')) {
+            return;
+        }
+        let top = tracklistListDOM.offset().top;
+        let bottom = top + tracklistListDOM.innerHeight();
+        let indices = [];
+        tracklistListDOM.children('.track').each(function(index, elem) {
+            let position = $(elem).offset().top;
+            if (position + elem.offsetHeight > top && position < bottom) {
+                indices.push(parseInt(elem.dataset.data));
+            }
+        });
+        if (indices.length == 0) {
+            return;
+        }
+        let range = [Math.min(...indices), Math.max(...indices)];
+        if (range.toString() != visibleTracks) {
+            visibleTracks = range.toString();
+            sendCmd('tracklist_visible', range);
+        }
+    }, 250);
+}
+function getTrackSettings(track, index) {
+    // return the segment settings of a track at index
+    return {
+        mrl: track.mrl,
+        data: index,
+        index: index,
+        artist: track.artist,
+        title: track.title,
+        duration: track.duration
+    }
+}
+function updateTracklistSummary() {
+    // update the number of tracks and the total duration
+    let totalDuration = 0;
+    for (let index = 0; index < globalTracklist.length; index++) {
+        totalDuration += globalTracklist[index].duration;
+    }
+    tracklistBadgeDOM.text(globalTracklist.length);
+    tracklistListHeaderDurationDOM.text(getDuration(totalDuration));
+}
+function markCurrentTrack() {
+    // highlight the current track in the tracklist
+    if (markedTrack) {
+        markedTrack.removeClass('playing paused');
+    }
+    markedTrack = tracklistSegments[globalCurrent.index];
+    if (markedTrack && ['play', 'pause'].includes(globalCurrent.state)) {
+        markedTrack.addClass('playing');
+        if (globalCurrent.state == 'pause') {
+            markedTrack.addClass('paused');
+        }
+    }
+}
+function renumberTracklist(start) {
+    // update the index of the segments from start to the end
+    for (let index = start; index < tracklistSegments.length; index++) {
+        let segment = tracklistSegments[index];
+        segment.attr('data-data', index);
+        segment.children('.index').text((index + 1) + '.');
+        segment.properties.data = index;
+        segment.properties.index = index;
+    }
+}
+function requestTracklistSnapshot() {
+    // request the whole tracklist, if a patch did not fit the known version
+    if (!tracklistSnapshotRequested) {
+        tracklistSnapshotRequested = true;
+        sendCmd('tracklist_update');
+    }
+}
+function patchTracklist(patch) {
+    // apply the changes of a tracklist patch to the known tracklist
+    if (patch.version <= globalTracklistVersion) {
+        return;
+    }
+    if (patch.from != globalTracklistVersion) {
+        requestTracklistSnapshot();
+        return;
+    }
+    // the search removes segments from the DOM, so it is repeated afterwards
+    let tracklistSearched = tracklistSearch.searched;
+    if (tracklistSearched) {
+        tracklistSearch.search();
+    }
+    let renumber = tracklistSegments.length;
+    for (let op of patch.ops) {
+        switch (op.op) {
+            case 'insert': {
+                let segments = [];
+                for (let i = 0; i < op.tracks.length; i++) {
+                    segments.push(createTracklistSegment(getTrackSettings(op.tracks[i], op.index + i)));
+                }
+                let next = tracklistSegments[op.index];
+                if (next && next.parent().length) {
+                    next.before(segments);
+                } else {
+                    tracklistListDOM.append(segments);
+                }
+                globalTracklist.splice(op.index, 0, ...op.tracks);
+                tracklistSegments.splice(op.index, 0, ...segments);
+                renumber = Math.min(renumber, op.index + op.tracks.length);
+                break;
+            }
+            case 'remove':
+                for (let index of op.indices) {
+                    tracklistSegments[index].remove();
+                    globalTracklist.splice(index, 1);
+                    tracklistSegments.splice(index, 1);
+                    renumber = Math.min(renumber, index);
+                }
+                break;
+            case 'update':
+                for (let track of op.tracks) {
+                    let index = track.index;
+                    Object.assign(globalTracklist[index], track);
+                    let old = tracklistSegments[index];
+                    let segment = createTracklistSegment(getTrackSettings(globalTracklist[index], index));
+                    segment.find('.mark').prop('checked', old.find('.mark').prop('checked'));
+                    old.replaceWith(segment);
+                    tracklistSegments[index] = segment;
+                }
+                break;
+            case 'current':
+                globalCurrent.index = op.index;
+                break;
+            case 'clear':
+                globalTracklist = [];
+                tracklistSegments = [];
+                tracklistListDOM.empty();
+                renumber = 0;
+                clearMarks('tracklist');
+                break;
+        }
+    }
+    globalTracklistVersion = patch.version;
+    renumberTracklist(renumber);
+    markCurrentTrack();
+    updateTracklistSummary();
+    tracklistSearch.reIndex();
+    if (tracklistSearched) {
+        tracklistSearch.search(tracklistHeaderSearchDOM.attr('data-value'));
+    }
+    backupTracklist = globalTracklist;
+}
 function createTracklistSegment(settings) {
     // creates a single segment for the tracklist based on the given settings
     /*
@@ -1417,6 +1725,7 @@ function attachEventListener() {
                     tracklistListDOM.scrollTop(currentTrack - firstTrack);
                 }
             }
+            sendVisibleTracks();
         };
     })
     .on('click', '.button.theme', function(e) {
@@ -1553,6 +1862,8 @@ function attachEventListener() {
                         let index = shownSegments.length + i;
                         directoryDOM.append(directoryContent[index]);
                     }
+                } else if (globalData.search) {
+                    requestSearchPage();
                 }
             }
             // move search button if overlap a segment
@@ -1620,6 +1931,7 @@ function attachEventListener() {
         // SEARCH: search in directory
         if (searchBadgeDOM.text() != "") {
             clearSearchDirectory();
+            globalData.search = undefined;
             sendCmd("system_get_directory", globalData.current_path);
         } else {
             createDialog({
@@ -1634,11 +1946,25 @@ function attachEventListener() {
                     searchIconDOM.attr('title', getTranslation('tooltip.clearSearch'))
                                  .children('i').toggleClass('fa-search-minus');
                     searchBadgeDOM.text('"'+value+'"').show();
-                }
+                },
+                buttons: [{
+                    label: getTranslation('dialog.button.searchLibrary'),
+                    function: function(e) {
+                        // SEARCH: search in the whole library
+                        let value = e.data.dialog.value.val();
+                        if (value != "") {
+                            searchLibrary(value);
+                        }
+                    }
+                }]
             })
         }
     });
     // TRACKLIST EVENTS //
+    tracklistListDOM.on('scroll', function(e) {
+        // TRACKLIST: report the visible tracks
+        sendVisibleTracks();
+    });
     tracklistDOM.on('click', '.close', function(e) {
         // TRACKLIST: hide tracklist
         tracklistDOM.hide();